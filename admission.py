@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+
+ADMISSION_ENABLED = os.environ.get("ADMISSION_ENABLED", "true").lower() == "true"
+READ_RATE = float(os.environ.get("ADMISSION_READ_RATE", 50))
+READ_BURST = float(os.environ.get("ADMISSION_READ_BURST", 100))
+WRITE_RATE = float(os.environ.get("ADMISSION_WRITE_RATE", 10))
+WRITE_BURST = float(os.environ.get("ADMISSION_WRITE_BURST", 50))
+MAX_IN_FLIGHT = int(os.environ.get("ADMISSION_MAX_IN_FLIGHT",
+                                   int(os.environ.get("DB_POOL_SIZE", 10)) + int(os.environ.get("DB_MAX_OVERFLOW", 20))))
+QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 0))
+MAX_BUCKETS = int(os.environ.get("ADMISSION_MAX_BUCKETS", 100000))
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        """Take a token and return 0, or return the seconds until one is available."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Admission:
+    """Token buckets per client and route class, plus a limit on the requests running at once.
+
+    ``limits`` maps a route class to its ``(rate per second, burst)``; a rate of 0 disables the bucket,
+    and ``max_in_flight`` 0 disables the concurrency limit.
+    """
+
+    def __init__(self, limits, max_in_flight, queue_timeout=0, max_buckets=MAX_BUCKETS):
+        self.limits = dict(limits)
+        self.max_in_flight = max_in_flight
+        self.queue_timeout = queue_timeout
+        self.max_buckets = max_buckets
+        self.in_flight = 0
+        self.buckets = OrderedDict()
+        self.results = Counter()
+        self._slots = threading.BoundedSemaphore(max_in_flight) if max_in_flight > 0 else None
+        self._lock = threading.Lock()
+
+    def admit(self, key, route_class, wait=True):
+        """Return None when the request may run, otherwise its status code and the seconds to retry after.
+
+        An admitted request holds a slot until ``release`` is called.
+        """
+        rate, burst = self.limits[route_class]
+        if rate > 0:
+            now = time.monotonic()
+            with self._lock:
+                bucket = self.buckets.get((key, route_class))
+                if bucket is None:
+                    bucket = self.buckets[(key, route_class)] = TokenBucket(rate, burst, now)
+                    while len(self.buckets) > self.max_buckets:
+                        self.buckets.popitem(last=False)
+                else:
+                    self.buckets.move_to_end((key, route_class))
+                retry_after = bucket.take(now)
+                if retry_after:
+                    self.results[(route_class, "rate_limited")] += 1
+                    return 429, retry_after
+        if self._slots is not None:
+            if wait and self.queue_timeout > 0:
+                acquired = self._slots.acquire(timeout=self.queue_timeout)
+            else:
+                acquired = self._slots.acquire(blocking=False)
+            if not acquired:
+                with self._lock:
+                    self.results[(route_class, "overloaded")] += 1
+                return 503, 1
+        with self._lock:
+            self.in_flight += 1
+            self.results[(route_class, "admitted")] += 1
+        return None
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        if self._slots is not None:
+            self._slots.release()
+
+    def render(self):
+        with self._lock:
+            lines = ["# HELP admission_requests_total Requests by route class and admission result.",
+                     "# TYPE admission_requests_total counter"]
+            lines.extend(f'admission_requests_total{{class="{route_class}",result="{result}"}} {count}'
+                         for (route_class, result), count in sorted(self.results.items()))
+            lines.extend(["# HELP admission_in_flight Admitted requests still running.", "# TYPE admission_in_flight gauge",
+                          f"admission_in_flight {self.in_flight}",
+                          "# HELP admission_max_in_flight Limit of admitted requests running at once.",
+                          "# TYPE admission_max_in_flight gauge", f"admission_max_in_flight {self.max_in_flight}",
+                          "# HELP admission_buckets Token buckets of recently seen clients.",
+                          "# TYPE admission_buckets gauge", f"admission_buckets {len(self.buckets)}"])
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self.buckets.clear()
+            self.results.clear()
+
+
+def route_class(method):
+    return "read" if method in ("GET", "HEAD") else "write"
+
+
+admission = Admission({"read": (READ_RATE, READ_BURST) if ADMISSION_ENABLED else (0, 0),
+                       "write": (WRITE_RATE, WRITE_BURST) if ADMISSION_ENABLED else (0, 0)},
+                      MAX_IN_FLIGHT if ADMISSION_ENABLED else 0, QUEUE_TIMEOUT)
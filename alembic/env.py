@@ -62,7 +62,7 @@ def run_migrations_online():
     and associate a connection with the context.
 
     """
-    connectable = engine
+    connectable = get_engine()
 
     with connectable.connect() as connection:
         context.configure(
@@ -0,0 +1,33 @@
+"""add enrollment counters
+
+Revision ID: 5d3e8a1f7c20
+Revises: c27e90f4b613
+Create Date: 2026-10-18 13:12:44.208317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d3e8a1f7c20'
+down_revision = 'c27e90f4b613'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('pendingRequestCount', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('course', sa.Column('memberCount', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('course', sa.Column('pendingRequestCount', sa.Integer(), nullable=False, server_default='0'))
+    op.execute('UPDATE course SET memberCount = (SELECT COUNT(*) FROM courseMember WHERE courseId = course.id), '
+               'pendingRequestCount = (SELECT COUNT(*) FROM request '
+               'WHERE requestToCourse = course.id AND status = \'OnHold\')')
+    op.execute('UPDATE user SET pendingRequestCount = (SELECT COUNT(*) FROM request '
+               'WHERE requestToLector = user.id AND status = \'OnHold\')')
+
+
+def downgrade():
+    op.drop_column('course', 'pendingRequestCount')
+    op.drop_column('course', 'memberCount')
+    op.drop_column('user', 'pendingRequestCount')
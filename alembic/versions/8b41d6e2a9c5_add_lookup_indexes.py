@@ -0,0 +1,57 @@
+"""add lookup indexes
+
+Revision ID: 8b41d6e2a9c5
+Revises: 3f9a2c71d0b4
+Create Date: 2026-10-18 11:04:19.552871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b41d6e2a9c5'
+down_revision = '3f9a2c71d0b4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_course_courseLector', 'course', ['courseLector'])
+    op.create_index('ix_course_courseName', 'course', ['courseName'])
+    op.create_index('ix_request_requestToLector_status', 'request', ['requestToLector', 'status'])
+    op.create_index('ix_request_studentId_requestToCourse', 'request', ['studentId', 'requestToCourse'])
+    # keep the oldest row of every duplicated membership so the unique constraint can be created
+    op.execute('DELETE FROM courseMember WHERE id NOT IN '
+               '(SELECT id FROM (SELECT MIN(id) AS id FROM courseMember GROUP BY courseId, userId) AS keep)')
+    op.create_unique_constraint('uq_courseMember_courseId_userId', 'courseMember', ['courseId', 'userId'])
+    op.create_index('ix_courseMember_userId', 'courseMember', ['userId'])
+
+
+# (name, table, column, referenced table) of the foreign keys whose index MySQL replaced with one of the indexes above;
+# the names are the MySQL defaults of the initial schema
+FOREIGN_KEYS = (
+    ('course_ibfk_1', 'course', 'courseLector', 'user'),
+    ('courseMember_ibfk_1', 'courseMember', 'courseId', 'course'),
+    ('courseMember_ibfk_2', 'courseMember', 'userId', 'user'),
+    ('request_ibfk_1', 'request', 'studentId', 'user'),
+    ('request_ibfk_3', 'request', 'requestToLector', 'user'),
+)
+
+
+def downgrade():
+    # MySQL refuses to drop the index of a foreign key (error 1553), so the keys are dropped first and created again
+    # afterwards, which gives them back an index of their own
+    mysql = op.get_bind().dialect.name == 'mysql'
+    if mysql:
+        for name, table, column, referenced in FOREIGN_KEYS:
+            op.drop_constraint(name, table, type_='foreignkey')
+    op.drop_index('ix_courseMember_userId', table_name='courseMember')
+    op.drop_constraint('uq_courseMember_courseId_userId', 'courseMember', type_='unique')
+    op.drop_index('ix_request_studentId_requestToCourse', table_name='request')
+    op.drop_index('ix_request_requestToLector_status', table_name='request')
+    op.drop_index('ix_course_courseName', table_name='course')
+    op.drop_index('ix_course_courseLector', table_name='course')
+    if mysql:
+        for name, table, column, referenced in FOREIGN_KEYS:
+            op.create_foreign_key(name, table, referenced, [column], ['id'])
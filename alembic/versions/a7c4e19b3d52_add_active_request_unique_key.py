@@ -0,0 +1,36 @@
+"""add active request unique key
+
+Revision ID: a7c4e19b3d52
+Revises: 5d3e8a1f7c20
+Create Date: 2026-10-18 15:41:07.118620
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c4e19b3d52'
+down_revision = '5d3e8a1f7c20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # decline all but the oldest open request of every student and course so the unique key can be created
+    op.execute('UPDATE request SET status = \'Declined\' WHERE status <> \'Declined\' AND id NOT IN '
+               '(SELECT id FROM (SELECT MIN(id) AS id FROM request WHERE status <> \'Declined\' '
+               'GROUP BY studentId, requestToCourse) AS keep)')
+    op.execute('UPDATE course SET pendingRequestCount = (SELECT COUNT(*) FROM request '
+               'WHERE requestToCourse = course.id AND status = \'OnHold\')')
+    op.execute('UPDATE user SET pendingRequestCount = (SELECT COUNT(*) FROM request '
+               'WHERE requestToLector = user.id AND status = \'OnHold\')')
+    op.add_column('request', sa.Column('activeStudentId', sa.Integer(), sa.Computed(
+        "CASE WHEN status <> 'Declined' THEN studentId END", persisted=True)))
+    op.create_unique_constraint('uq_request_activeStudentId_requestToCourse', 'request',
+                                ['activeStudentId', 'requestToCourse'])
+
+
+def downgrade():
+    op.drop_constraint('uq_request_activeStudentId_requestToCourse', 'request', type_='unique')
+    op.drop_column('request', 'activeStudentId')
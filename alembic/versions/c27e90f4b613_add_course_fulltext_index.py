@@ -0,0 +1,24 @@
+"""add course fulltext index
+
+Revision ID: c27e90f4b613
+Revises: 8b41d6e2a9c5
+Create Date: 2026-10-18 12:37:05.904126
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c27e90f4b613'
+down_revision = '8b41d6e2a9c5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_course_fulltext', 'course', ['courseName', 'courseDescription'], mysql_prefix='FULLTEXT')
+
+
+def downgrade():
+    op.drop_index('ix_course_fulltext', table_name='course')
@@ -0,0 +1,38 @@
+"""cascade enrollment deletes
+
+Revision ID: e2b9f5c8a613
+Revises: a7c4e19b3d52
+Create Date: 2026-10-18 16:27:52.904118
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b9f5c8a613'
+down_revision = 'a7c4e19b3d52'
+branch_labels = None
+depends_on = None
+
+# (old name, new name, table, column, referenced table, ON DELETE); the old names are the MySQL defaults of the
+# initial schema. request.studentId keeps no action because MySQL rejects CASCADE on a base column of the stored
+# generated activeStudentId, so the app deletes a user's requests itself.
+FOREIGN_KEYS = (
+    ('request_ibfk_1', 'fk_request_studentId', 'request', 'studentId', 'user', None),
+    ('request_ibfk_2', 'fk_request_requestToCourse', 'request', 'requestToCourse', 'course', 'CASCADE'),
+    ('request_ibfk_3', 'fk_request_requestToLector', 'request', 'requestToLector', 'user', 'CASCADE'),
+    ('courseMember_ibfk_1', 'fk_courseMember_courseId', 'courseMember', 'courseId', 'course', 'CASCADE'),
+    ('courseMember_ibfk_2', 'fk_courseMember_userId', 'courseMember', 'userId', 'user', 'CASCADE'),
+)
+
+
+def upgrade():
+    for old_name, new_name, table, column, referenced, ondelete in FOREIGN_KEYS:
+        op.drop_constraint(old_name, table, type_='foreignkey')
+        op.create_foreign_key(new_name, table, referenced, [column], ['id'], ondelete=ondelete)
+
+
+def downgrade():
+    for old_name, new_name, table, column, referenced, ondelete in FOREIGN_KEYS:
+        op.drop_constraint(new_name, table, type_='foreignkey')
+        op.create_foreign_key(old_name, table, referenced, [column], ['id'])
@@ -0,0 +1,26 @@
+"""add user contact fields
+
+Revision ID: f3c1d7a9b204
+Revises: e2b9f5c8a613
+Create Date: 2026-10-18 13:05:12.480215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3c1d7a9b204'
+down_revision = 'e2b9f5c8a613'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('email', sa.String(45), nullable=True))
+    op.add_column('user', sa.Column('phone', sa.String(45), nullable=True))
+
+
+def downgrade():
+    op.drop_column('user', 'phone')
+    op.drop_column('user', 'email')
@@ -1,10 +1,25 @@
 from flask import Flask
-from routes import query
+from routes import query, replicas
 from flask_cors import CORS
 
-app = Flask(__name__)
-app.register_blueprint(query)
-CORS(app)
+from database.tables import configure
+
+
+def create_app(config=None):
+    """Build the app. Engines are only created by the first request, with the database settings of ``config``.
+
+    The settings and engines are those of the process, so the last app created decides them for every app.
+    """
+    app = Flask(__name__)
+    app.config.update(config or {})
+    configure(app.config)
+    replicas.reset()
+    app.register_blueprint(query)
+    CORS(app)
+    return app
+
+
+app = create_app()
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,461 @@
+import asyncio
+import base64
+import tempfile
+import time
+from functools import wraps
+
+from quart import Blueprint, Quart, Response, g, jsonify, make_response, request
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.util import await_only
+
+from database.tables import Base, configure, database_url, engine_hooks, engine_options, is_memory, replica_urls, \
+    setting
+from database.cascade import delete_course_in_chunks, logger
+from database.routing import ReplicaPool, RoutingSession
+from database.listing import available_courses, lector_courses, student_courses
+from cache import response_etag
+from exporter import EXPORTS, FORMATTERS, MIMETYPES, BATCH_SIZE
+from metrics import current_stats, metrics, start_request
+from passwords import check_password_async, hash_password_async
+from admission import admission, route_class
+from events import EVENT_HEARTBEAT, EVENT_RETRY_MS, EVENT_STREAM_TIMEOUT, bus, last_event_id, stream_chunks
+from handlers import admission_key, admission_refusal, catalog_version, course_version, memberships, \
+    reads_from_replica, responses, versions
+import handlers
+
+
+def async_url(url):
+    if url.startswith("sqlite"):
+        return url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    return url.replace("+pymysql", "+aiomysql", 1)
+
+
+def create_async_database_engine(url):
+    database_engine = create_async_engine(url, **engine_options(url))
+    for hook in engine_hooks:
+        hook(database_engine.sync_engine)
+    return database_engine
+
+
+_async_engines = {}
+
+
+async def get_async_engine():
+    """The primary engine of the async app, created on first use like ``get_engine``."""
+    engine = _async_engines.get("primary")
+    if engine is None:
+        url = setting("ASYNC_DATABASE_URL") or async_url(database_url())
+        engine = _async_engines.setdefault("primary", create_async_database_engine(url))
+        if is_memory(url):
+            async with engine.begin() as connection:
+                await connection.run_sync(Base.metadata.create_all)
+    return engine
+
+
+def get_async_replica_engines():
+    if "replicas" not in _async_engines:
+        _async_engines["replicas"] = [create_async_database_engine(async_url(url)) for url in replica_urls()]
+    return [engine.sync_engine for engine in _async_engines["replicas"]]
+
+
+async def dispose_async_engines():
+    engines = [_async_engines.pop("primary", None), *_async_engines.pop("replicas", [])]
+    for engine in engines:
+        if engine is not None:
+            await engine.dispose()
+    async_replicas.reset()
+
+
+async_replicas = ReplicaPool(get_async_replica_engines)
+async_session = sessionmaker(class_=AsyncSession, expire_on_commit=False, sync_session_class=RoutingSession,
+                             replicas=async_replicas)
+
+async_query = Blueprint("async_query", __name__)
+
+
+@async_query.before_app_request
+async def open_session():
+    start_request()
+    g.db = async_session(bind=await get_async_engine())
+    g.db.sync_session.info["replica"] = reads_from_replica(request.method, request.headers)
+
+
+@async_query.after_app_request
+async def add_server_timing(response):
+    stats = current_stats.get()
+    if stats is not None:
+        response.headers["Server-Timing"] = stats.server_timing()
+        metrics.observe(request.method, request.url_rule.rule if request.url_rule else "unmatched",
+                        response.status_code, stats)
+    return response
+
+
+@async_query.teardown_app_request
+async def close_session(exception=None):
+    db = g.pop("db", None)
+    if db is not None:
+        await db.close()
+
+
+@async_query.before_request
+async def admit_request():
+    if request.method == "OPTIONS":
+        return None
+    # never wait for a slot here, that would block the event loop
+    refused = admission.admit(admission_key(request.headers.get("Authorization", ""), request.remote_addr),
+                              route_class(request.method), wait=False)
+    if refused is not None:
+        return admission_refusal(*refused)
+    g.admitted = True
+
+
+@async_query.teardown_request
+async def release_admission(exception=None):
+    if g.pop("admitted", False):
+        admission.release()
+
+
+def check_password(password, stored):
+    # handlers run in a run_sync greenlet, so they can wait for the password pool without blocking the loop
+    return await_only(check_password_async(password, stored))
+
+
+def hash_password(password):
+    return await_only(hash_password_async(password))
+
+
+async def authenticate():
+    scheme, _, credentials = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() == "basic":
+        try:
+            username, _, password = base64.b64decode(credentials).decode("utf-8").partition(":")
+        except ValueError:
+            return False
+        return await g.db.run_sync(handlers.verify_password, username, password, check_password, hash_password)
+    if scheme.lower() == "bearer":
+        return await g.db.run_sync(handlers.verify_token, credentials)
+    return False
+
+
+def current_user():
+    return g.principal
+
+
+def reply(result):
+    body, *rest = result
+    return (jsonify(body) if isinstance(body, list) else body, *rest)
+
+
+def login_required(func):
+    @wraps(func)
+    async def decorated_function(*args, **kwargs):
+        principal = await authenticate()
+        if not principal:
+            return Response("Unauthorized Access", 401, {"WWW-Authenticate": 'Basic realm="Authentication Required"'})
+        g.principal = principal
+        return await func(*args, **kwargs)
+
+    return decorated_function
+
+
+def permission_required(permission):
+    def decorator(func):
+        @wraps(func)
+        async def decorated_function(*args, **kwargs):
+            error = handlers.permission_error(current_user(), permission)
+            if error is not None:
+                return error
+            return await func(*args, **kwargs)
+
+        return decorated_function
+
+    return decorator
+
+
+def cached_response(version_of):
+    def decorator(func):
+        @wraps(func)
+        async def decorated_function(*args, **kwargs):
+            user_id = current_user().id
+            etag = response_etag(versions.epoch, request.endpoint, request.query_string, user_id,
+                                 version_of(user_id, **kwargs))
+            if request.if_none_match.contains(etag):
+                response = Response("", status=304)
+            else:
+                cached = responses.get(etag)
+                if cached is None:
+                    response = await make_response(await func(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    if g.db.sync_session.may_be_stale():
+                        # the replica may not have the writes the versions in the ETag stand for yet
+                        return response
+                    cached = (await response.get_data(), response.mimetype)
+                    responses.set(etag, cached)
+                response = Response(cached[0], mimetype=cached[1])
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "private, no-cache"
+            return response
+
+        return decorated_function
+
+    return decorator
+
+
+@async_query.route('/user/<string:username>', methods=['GET'])
+@login_required
+async def get_user(username):
+    return await g.db.run_sync(handlers.get_user, current_user(), username)
+
+
+@async_query.route('/user/<string:username>', methods=['PUT'])
+@login_required
+async def update_user(username):
+    return await g.db.run_sync(handlers.update_user, current_user(), username, await request.get_json(),
+                               hash_password)
+
+
+@async_query.route('/user/<string:username>', methods=['DELETE'])
+@login_required
+async def delete_user(username):
+    return await g.db.run_sync(handlers.delete_user, current_user(), username)
+
+
+@async_query.route('/user/acceptrequest/<int:request_id>', methods=['PUT'])
+@login_required
+@permission_required('Lector')
+async def accept_request(request_id):
+    return await g.db.run_sync(handlers.accept_request, request_id)
+
+
+@async_query.route('/user/declinerequest/<int:request_id>', methods=['PUT'])
+@login_required
+@permission_required('Lector')
+async def decline_request(request_id):
+    return await g.db.run_sync(handlers.decline_request, request_id)
+
+
+@async_query.route('/user/requests', methods=['PUT'])
+@login_required
+@permission_required('Lector')
+async def handle_requests():
+    return reply(await g.db.run_sync(handlers.handle_requests, current_user(), await request.get_json()))
+
+
+@async_query.route('/course', methods=['POST'])
+@login_required
+@permission_required('Lector')
+async def add_course():
+    return await g.db.run_sync(handlers.add_course, await request.get_json())
+
+
+@async_query.route('/course/<int:course_id>', methods=['GET'])
+@login_required
+@cached_response(course_version)
+async def get_course(course_id):
+    return await g.db.run_sync(handlers.get_course, current_user(), course_id)
+
+
+@async_query.route('/lector/courses', methods=['GET'])
+@login_required
+@permission_required('Lector')
+@cached_response(catalog_version)
+async def get_all_courses_lector():
+    return await g.db.run_sync(handlers.course_page, lector_courses, current_user(), request.args)
+
+
+@async_query.route('/user/course', methods=['GET'])
+@login_required
+@permission_required('Lector')
+async def get_user_courses():
+    return reply(await g.db.run_sync(handlers.user_courses, current_user()))
+
+
+@async_query.route('/student/courses', methods=['GET'])
+@login_required
+@cached_response(catalog_version)
+async def get_all_courses_student():
+    return await g.db.run_sync(handlers.course_page, student_courses, current_user(), request.args)
+
+
+@async_query.route('/courses', methods=['GET'])
+@login_required
+@cached_response(catalog_version)
+async def get_all_courses():
+    return await g.db.run_sync(handlers.course_page, available_courses, current_user(), request.args)
+
+
+@async_query.route('/courses/search', methods=['GET'])
+@login_required
+@cached_response(catalog_version)
+async def search_course():
+    return await g.db.run_sync(handlers.search_course, request.args)
+
+
+@async_query.route('/course/<int:course_id>', methods=['PUT'])
+@login_required
+@permission_required('Lector')
+async def update_course(course_id):
+    return await g.db.run_sync(handlers.update_course, course_id, await request.get_json())
+
+
+@async_query.route('/course/<int:course_id>', methods=['DELETE'])
+@login_required
+@permission_required('Lector')
+async def delete_course(course_id):
+    later = None
+    if request.args.get("background", "false").lower() == "true":
+        later = start_delete_course
+    return await g.db.run_sync(handlers.delete_course, course_id, later)
+
+
+background_tasks = set()
+
+
+def start_delete_course(course_id):
+    # called from the handler's run_sync greenlet, which runs on the event loop
+    task = asyncio.get_running_loop().create_task(delete_course_later(course_id))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def delete_course_later(course_id):
+    try:
+        async with async_session(bind=await get_async_engine()) as db:
+            await db.run_sync(delete_course_in_chunks, course_id)
+        memberships.clear()
+        versions.bump_course(course_id)
+    except Exception:
+        logger.exception("Deleting course %s in the background failed", course_id)
+
+
+@async_query.route('/lector/requests', methods=['GET'])
+@login_required
+@permission_required('Lector')
+@cached_response(catalog_version)
+async def get_all_requests():
+    return await g.db.run_sync(handlers.request_page, current_user(), request.args)
+
+
+@async_query.route('/request', methods=['POST'])
+@login_required
+@permission_required('Student')
+async def add_request():
+    return await g.db.run_sync(handlers.add_request, current_user(), await request.get_json())
+
+
+@async_query.route('/import/<string:kind>', methods=['POST'])
+@login_required
+@permission_required('Lector')
+async def import_data(kind):
+    fmt = request.args.get('format', 'csv' if request.mimetype == 'text/csv' else 'ndjson')
+    error = handlers.import_error(kind, fmt)
+    if error is not None:
+        return error
+    files = await request.files
+    with tempfile.TemporaryFile() as upload:
+        if 'file' in files:
+            files['file'].save(upload)
+        else:
+            async for data in request.body:
+                upload.write(data)
+        upload.seek(0)
+        return await g.db.run_sync(handlers.import_data, kind, fmt, upload)
+
+
+@async_query.route('/export/<string:kind>', methods=['GET'])
+@login_required
+@permission_required('Lector')
+async def export_data(kind):
+    fmt = request.args.get('format', 'ndjson')
+    error = handlers.export_error(kind, fmt)
+    if error is not None:
+        return error
+    statement = EXPORTS[kind](current_user().id)
+
+    async def generate():
+        async with async_session(bind=await get_async_engine()) as db:
+            result = await db.stream(statement)
+            first = True
+            async for rows in result.partitions(BATCH_SIZE):
+                yield FORMATTERS[fmt](rows, first)
+                first = False
+
+    return Response(generate(), mimetype=MIMETYPES[fmt])
+
+
+@async_query.route('/events', methods=['GET'])
+@login_required
+async def get_events():
+    user_id = current_user().id
+    last_id = last_event_id(request.headers.get("Last-Event-ID", request.args.get("lastEventId")), bus.last_id)
+
+    async def generate(last_id):
+        yield f"retry: {EVENT_RETRY_MS}\n\n"
+        deadline = time.monotonic() + EVENT_STREAM_TIMEOUT
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            events, position = await bus.wait_async(user_id, last_id, min(EVENT_HEARTBEAT, remaining))
+            yield "".join(stream_chunks(events, last_id, position))
+            last_id = position
+
+    return Response(generate(last_id), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@async_query.route('/metrics', methods=['GET'])
+async def get_metrics():
+    return Response(handlers.metrics_text(), mimetype="text/plain; version=0.0.4")
+
+
+@async_query.route('/auth/register', methods=['POST'])
+async def add_user():
+    return await g.db.run_sync(handlers.add_user, await request.get_json(), hash_password)
+
+
+@async_query.route('/auth/login', methods=['POST'])
+async def login_post():
+    return await g.db.run_sync(handlers.login, await request.get_json(), check_password, hash_password)
+
+
+@async_query.route('/auth/refresh', methods=['POST'])
+@login_required
+async def refresh_token():
+    return await g.db.run_sync(handlers.issue_token, current_user()), 200
+
+
+@async_query.route('/auth/revoke', methods=['POST'])
+@login_required
+async def revoke_token():
+    return await g.db.run_sync(handlers.revoke_token, current_user())
+
+
+async def allow_cross_origin(response):
+    response.headers.setdefault("Access-Control-Allow-Origin", "*")
+    return response
+
+
+def create_app(config=None):
+    """Build the async app. Engines are only created by the first request, with the database settings of ``config``.
+
+    Like ``app.create_app`` it sets the database settings of the whole process; the replica pool of the WSGI app is
+    left alone.
+    """
+    app = Quart(__name__)
+    app.config.update(config or {})
+    configure(app.config)
+    _async_engines.clear()
+    async_replicas.reset()
+    app.register_blueprint(async_query)
+    app.after_request(allow_cross_origin)
+    return app
+
+
+app = create_app()
+
+
+if __name__ == '__main__':
+    app.run(debug=True)
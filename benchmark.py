@@ -0,0 +1,536 @@
+import argparse
+import base64
+import http.client
+import json
+import logging
+import math
+import os
+import platform
+import random
+import threading
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+
+import sqlalchemy
+from sqlalchemy import event, insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+ITERATIONS = 200
+WARMUP = 20
+CONCURRENCY = 8
+SEED_CHUNK_SIZE = 10000
+PASSWORD = "12345"
+WORDS = ("python", "java", "algebra", "history", "biology", "chemistry", "physics", "design", "databases", "networks",
+         "statistics", "economics", "marketing", "painting", "music", "writing", "philosophy", "law", "medicine",
+         "astronomy", "geology", "robotics", "security", "compilers", "graphics", "linux", "cloud", "finance",
+         "spanish", "german", "poetry", "film", "ethics", "calculus", "geometry", "logic", "testing", "web",
+         "mobile", "games")
+
+Sizes = namedtuple("Sizes", ["users", "lectors", "courses", "members", "requests"])
+Call = namedtuple("Call", ["method", "path", "user", "json", "data", "content_type"], defaults=(None, None, None))
+
+
+def dataset_sizes(users, courses, members, requests):
+    """Clamp the requested sizes to what the seeded layout can hold.
+
+    Users ``1..lectors`` are lectors and the rest students. Course ``c`` belongs to lector
+    ``(c - 1) % lectors + 1``, and the ``k``-th membership or request of the ``i``-th student is for course
+    ``(i * 7919 + k) % courses + 1``, so any seeded row can be addressed by arithmetic alone.
+    """
+    lectors = max(1, users // 100)
+    students = max(1, users - lectors)
+    members = min(members, students * courses)
+    requests = min(requests, students * (courses - math.ceil(members / students)))
+    return Sizes(lectors + students, lectors, courses, members, requests)
+
+
+def student_id(sizes, index):
+    return sizes.lectors + 1 + index % (sizes.users - sizes.lectors)
+
+
+def lector_of(sizes, course_id):
+    return (course_id - 1) % sizes.lectors + 1
+
+
+def username(sizes, user_id):
+    return f"lector{user_id}" if user_id <= sizes.lectors else f"student{user_id}"
+
+
+def enrollment(sizes, number, offset=0):
+    """Return ``(student id, course id)`` of the ``number``-th seeded membership (or request with ``offset``)."""
+    students = sizes.users - sizes.lectors
+    index = number % students
+    return student_id(sizes, index), (index * 7919 + number // students + offset) % sizes.courses + 1
+
+
+def password_hash():
+    """One bcrypt hash of ``PASSWORD`` shared by every seeded user, at the configured cost."""
+    from passwords import hash_password
+
+    return hash_password(PASSWORD)
+
+
+def seed(engine, sizes, rng):
+    """Recreate the schema and fill it with a synthetic dataset using executemany inserts."""
+    from database.tables import Base, Course, CourseMember, Request, User
+    from database.counters import rebuild
+
+    hashed = password_hash()
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    if engine.dialect.name == "sqlite":
+        with engine.connect() as connection:
+            connection.exec_driver_sql("PRAGMA journal_mode=WAL")
+
+    users = ({"id": user_id, "username": username(sizes, user_id), "firstName": "firstName", "lastName": "lastName",
+              "password": hashed, "userType": "Lector" if user_id <= sizes.lectors else "Student"}
+             for user_id in range(1, sizes.users + 1))
+    courses = ({"id": course_id, "courseName": f"{rng.choice(WORDS)} {rng.choice(WORDS)} {course_id}",
+                "courseDescription": " ".join(rng.choice(WORDS) for _ in range(12)),
+                "courseLector": lector_of(sizes, course_id)}
+               for course_id in range(1, sizes.courses + 1))
+    members = ({"courseId": course_id, "userId": user_id}
+               for user_id, course_id in (enrollment(sizes, number) for number in range(sizes.members)))
+    per_student = math.ceil(sizes.members / (sizes.users - sizes.lectors))
+    requests = ({"studentId": user_id, "requestToCourse": course_id, "requestToLector": lector_of(sizes, course_id),
+                 "status": "Declined" if rng.random() < 0.2 else "OnHold"}
+                for user_id, course_id in (enrollment(sizes, number, per_student) for number in range(sizes.requests)))
+
+    for table, rows in ((User, users), (Course, courses), (CourseMember, members), (Request, requests)):
+        with engine.begin() as connection:
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) == SEED_CHUNK_SIZE:
+                    connection.execute(insert(table), chunk)
+                    chunk = []
+            if chunk:
+                connection.execute(insert(table), chunk)
+    rebuild(Session(engine))
+
+
+class Fixtures:
+    """Rows that write scenarios consume, inserted directly before the timed phase."""
+
+    def __init__(self, engine, sizes, rng):
+        self.engine = engine
+        self.sizes = sizes
+        self.rng = rng
+        self.password = password_hash()
+        self.run = uuid.uuid4().hex[:8]
+        self.numbers = count()
+
+    def name(self, prefix):
+        return f"{prefix}{self.run}x{next(self.numbers)}"
+
+    def insert(self, table, **values):
+        with self.engine.begin() as connection:
+            return connection.execute(insert(table).values(**values)).inserted_primary_key[0]
+
+    def user(self, user_type="Student"):
+        from database.tables import User
+
+        name = self.name("bench")
+        return self.insert(User, username=name, firstName="firstName", lastName="lastName", password=self.password,
+                           userType=user_type), name
+
+    def course(self, lector_id):
+        from database.tables import Course
+
+        return self.insert(Course, courseName=self.name("course"), courseDescription="description",
+                           courseLector=lector_id)
+
+    def request(self, lector_id):
+        from database.tables import Request
+
+        while True:
+            try:
+                return self.insert(Request, studentId=self.student(), requestToCourse=self.lector_course(lector_id),
+                                   requestToLector=lector_id, status="OnHold")
+            except IntegrityError:
+                # the student already has an open request for that course
+                continue
+
+    def student(self):
+        return student_id(self.sizes, self.rng.randrange(self.sizes.users - self.sizes.lectors))
+
+    def lector(self):
+        return self.rng.randint(1, min(self.sizes.lectors, self.sizes.courses))
+
+    def lector_course(self, lector_id):
+        return lector_id + self.sizes.lectors * self.rng.randrange((self.sizes.courses - lector_id) // self.sizes.lectors + 1)
+
+    def member(self):
+        return enrollment(self.sizes, self.rng.randrange(max(1, self.sizes.members)))
+
+
+def scenario_calls(fixtures):
+    """Map every endpoint to a function returning its next ``Call``."""
+    sizes = fixtures.sizes
+
+    def as_lector(method, path, **kwargs):
+        return Call(method, path, username(sizes, fixtures.lector()), **kwargs)
+
+    def as_student(method, path, **kwargs):
+        return Call(method, path, username(sizes, fixtures.student()), **kwargs)
+
+    def get_user():
+        name = username(sizes, fixtures.student())
+        return Call("GET", f"/user/{name}", name)
+
+    def update_user():
+        name = username(sizes, fixtures.student())
+        return Call("PUT", f"/user/{name}", name, json={"firstName": fixtures.rng.choice(WORDS)})
+
+    def delete_user():
+        _, name = fixtures.user()
+        return Call("DELETE", f"/user/{name}", name)
+
+    def accept_request():
+        lector_id = fixtures.lector()
+        return Call("PUT", f"/user/acceptrequest/{fixtures.request(lector_id)}", username(sizes, lector_id))
+
+    def decline_request():
+        lector_id = fixtures.lector()
+        return Call("PUT", f"/user/declinerequest/{fixtures.request(lector_id)}", username(sizes, lector_id))
+
+    def handle_requests():
+        lector_id = fixtures.lector()
+        ids = [fixtures.request(lector_id) for _ in range(50)]
+        return Call("PUT", "/user/requests", username(sizes, lector_id),
+                    json={"ids": ids, "action": fixtures.rng.choice(("accept", "decline"))})
+
+    def add_course():
+        lector_id = fixtures.lector()
+        return Call("POST", "/course", username(sizes, lector_id),
+                    json={"courseName": fixtures.name("course"), "courseDescription": "description",
+                          "courseLector": lector_id})
+
+    def get_course():
+        user_id, course_id = fixtures.member()
+        return Call("GET", f"/course/{course_id}", username(sizes, user_id))
+
+    def update_course():
+        lector_id = fixtures.lector()
+        course_id = fixtures.course(lector_id)
+        return Call("PUT", f"/course/{course_id}", username(sizes, lector_id),
+                    json={"courseName": fixtures.name("course"), "courseDescription": "description",
+                          "courseLector": lector_id})
+
+    def delete_course():
+        lector_id = fixtures.lector()
+        return Call("DELETE", f"/course/{fixtures.course(lector_id)}", username(sizes, lector_id))
+
+    def add_request():
+        user_id, name = fixtures.user()
+        return Call("POST", "/request", name,
+                    json={"studentId": user_id, "requestToCourse": fixtures.rng.randint(1, sizes.courses)})
+
+    def import_courses():
+        lector_id = fixtures.lector()
+        rows = "".join(f"{fixtures.name('course')},description,{lector_id}\n" for _ in range(100))
+        return Call("POST", "/import/courses?format=csv", username(sizes, lector_id),
+                    data="courseName,courseDescription,courseLector\n" + rows, content_type="text/csv")
+
+    def import_users():
+        # every row is a bcrypt hash, so a smaller file keeps the run short
+        rows = "".join(f"{fixtures.name('bench')},firstName,lastName,{PASSWORD},Student\n" for _ in range(10))
+        return Call("POST", "/import/users?format=csv", username(sizes, fixtures.lector()),
+                    data="username,firstName,lastName,password,userType\n" + rows, content_type="text/csv")
+
+    def import_members():
+        lector_id = fixtures.lector()
+        course_id = fixtures.course(lector_id)
+        students = fixtures.rng.sample(range(sizes.users - sizes.lectors), min(100, sizes.users - sizes.lectors))
+        rows = "".join(f"{course_id},{student_id(sizes, index)}\n" for index in students)
+        return Call("POST", "/import/members?format=csv", username(sizes, lector_id),
+                    data="courseId,userId\n" + rows, content_type="text/csv")
+
+    def register():
+        return Call("POST", "/auth/register", None,
+                    json={"username": fixtures.name("bench"), "firstName": "firstName", "lastName": "lastName",
+                          "password": PASSWORD, "userType": "Student"})
+
+    def login():
+        return Call("POST", "/auth/login", None,
+                    json={"username": username(sizes, fixtures.student()), "password": PASSWORD})
+
+    return {
+        "get_user": get_user,
+        "update_user": update_user,
+        "delete_user": delete_user,
+        "accept_request": accept_request,
+        "decline_request": decline_request,
+        "handle_requests": handle_requests,
+        "add_course": add_course,
+        "get_course": get_course,
+        "lector_courses": lambda: as_lector("GET", "/lector/courses"),
+        "student_courses": lambda: as_student("GET", "/student/courses"),
+        "courses": lambda: as_student("GET", "/courses"),
+        "courses_page": lambda: as_student("GET", f"/courses?sort=courseName&name={fixtures.rng.choice(WORDS)}"),
+        "search": lambda: as_student("GET", f"/courses/search?q={fixtures.rng.choice(WORDS)}"),
+        "update_course": update_course,
+        "delete_course": delete_course,
+        "lector_requests": lambda: as_lector("GET", "/lector/requests"),
+        "add_request": add_request,
+        "import_courses": import_courses,
+        "import_users": import_users,
+        "import_members": import_members,
+        "export_courses": lambda: as_lector("GET", "/export/courses"),
+        "export_members": lambda: as_lector("GET", "/export/members"),
+        "export_requests": lambda: as_lector("GET", "/export/requests"),
+        "events": lambda: as_student("GET", "/events?lastEventId=0"),
+        "metrics": lambda: Call("GET", "/metrics", None),
+        "register": register,
+        "login": login,
+        "refresh_token": lambda: as_student("POST", "/auth/refresh"),
+        "revoke_token": lambda: as_student("POST", "/auth/revoke"),
+    }
+
+
+def call_headers(call):
+    headers = {}
+    if call.user is not None:
+        headers["Authorization"] = "Basic " + base64.b64encode(f"{call.user}:{PASSWORD}".encode()).decode()
+    if call.content_type is not None:
+        headers["Content-Type"] = call.content_type
+    return headers
+
+
+class InProcessClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def send(self, call):
+        response = self.client.open(call.path, method=call.method, headers=call_headers(call), json=call.json,
+                                    data=call.data)
+        response.get_data()
+        return response.status_code
+
+
+class SocketClient:
+    """Keep-alive HTTP client with one connection per calling thread."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.local = threading.local()
+
+    def send(self, call):
+        headers = call_headers(call)
+        body = call.data
+        if call.json is not None:
+            body = json.dumps(call.json)
+            headers["Content-Type"] = "application/json"
+        for attempt in range(2):
+            if getattr(self.local, "connection", None) is None:
+                self.local.connection = http.client.HTTPConnection(self.host, self.port)
+            try:
+                self.local.connection.request(call.method, call.path, body=body, headers=headers)
+                response = self.local.connection.getresponse()
+                response.read()
+                return response.status
+            except (http.client.HTTPException, ConnectionError):
+                self.local.connection.close()
+                self.local.connection = None
+                if attempt:
+                    raise
+
+
+class StatementCounter:
+    def __init__(self, engine):
+        self.count = 0
+        self.enabled = False
+        self._lock = threading.Lock()
+        event.listen(engine, "before_cursor_execute", self.before_cursor_execute)
+
+    def before_cursor_execute(self, *args):
+        if self.enabled:
+            with self._lock:
+                self.count += 1
+
+
+def percentile(values, percent):
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def summarize(latencies, statuses, elapsed, statements):
+    latencies = sorted(latencies)
+    errors = {}
+    for status in statuses:
+        if status >= 400:
+            errors[str(status)] = errors.get(str(status), 0) + 1
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "latency_ms": {name: round(value * 1000, 3) for name, value in (
+            ("mean", sum(latencies) / len(latencies)), ("p50", percentile(latencies, 50)),
+            ("p95", percentile(latencies, 95)), ("p99", percentile(latencies, 99)))},
+        "sql_per_request": round(statements / len(latencies), 2),
+    }
+
+
+def run_scenario(client, calls, counter, concurrency, warmup):
+    for call in calls[:warmup]:
+        client.send(call)
+    calls = calls[warmup:]
+
+    def timed(call):
+        started = time.perf_counter()
+        status = client.send(call)
+        return time.perf_counter() - started, status
+
+    counter.count = 0
+    counter.enabled = True
+    started = time.perf_counter()
+    if concurrency == 1:
+        results = [timed(call) for call in calls]
+    else:
+        with ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(timed, calls))
+    elapsed = time.perf_counter() - started
+    counter.enabled = False
+    return summarize([latency for latency, _ in results], [status for _, status in results], elapsed, counter.count)
+
+
+def run(client, scenarios, counter, args, concurrency):
+    report = {}
+    for name, next_call in scenarios.items():
+        calls = [next_call() for _ in range(args.warmup + args.iterations)]
+        report[name] = run_scenario(client, calls, counter, concurrency, args.warmup)
+    return report
+
+
+def measure_serialization(engine, count):
+    """CPU time of dumping ``count`` course rows and ORM objects with marshmallow and with the compiled schemas."""
+    from marshmallow import Schema
+    from database.tables import Course
+    from database.listing import course_rows
+    from schema import CourseItemSchema, CourseSchema, get_schema
+
+    session = Session(engine)
+    sources = {"course_rows": (CourseItemSchema, course_rows(session).limit(count).all()),
+               "course_objects": (CourseSchema, session.query(Course).limit(count).all())}
+    report = {}
+    for name, (schema_class, rows) in sources.items():
+        schema = get_schema(schema_class, many=True)
+        timings = {}
+        for method, dump in (("marshmallow", lambda: Schema.dump(schema, rows)), ("compiled", lambda: schema.dump(rows))):
+            dump()
+            started = time.process_time()
+            dump()
+            timings[method + "_ms"] = round((time.process_time() - started) * 1000, 3)
+        report[name] = {"rows": len(rows), **timings}
+    session.close()
+    return report
+
+
+def measure_passwords(count):
+    """Wall time of hashing and verifying one password, and verifications per second through the worker pool."""
+    from passwords import BCRYPT_ROUNDS, PASSWORD_WORKERS, _check, check_password, executor, hash_password
+
+    started = time.perf_counter()
+    hashed = hash_password(PASSWORD)
+    hash_ms = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    check_password(PASSWORD, hashed)
+    verify_ms = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    list(executor.map(_check, [PASSWORD] * count, [hashed] * count))
+    elapsed = time.perf_counter() - started
+    return {"rounds": BCRYPT_ROUNDS, "workers": PASSWORD_WORKERS, "hash_ms": round(hash_ms, 3),
+            "verify_ms": round(verify_ms, 3), "verifications": count, "verify_per_second": round(count / elapsed, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed a synthetic dataset and benchmark every endpoint")
+    parser.add_argument("--database", default="sqlite:///benchmark.db")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--courses", type=int, default=10000)
+    parser.add_argument("--members", type=int, default=1000000)
+    parser.add_argument("--requests", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--reuse", action="store_true", help="keep the dataset of the previous run with the same sizes")
+    parser.add_argument("--iterations", type=int, default=ITERATIONS, help="timed requests per endpoint")
+    parser.add_argument("--warmup", type=int, default=WARMUP)
+    parser.add_argument("--mode", choices=("inprocess", "socket", "both"), default="both")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="client connections in socket mode")
+    parser.add_argument("--threads", type=int, default=CONCURRENCY, help="waitress threads in socket mode")
+    parser.add_argument("--only", nargs="+", help="endpoints to run")
+    parser.add_argument("--serialization-rows", type=int, default=10000, help="rows of the serialization measurement")
+    parser.add_argument("--bcrypt-rounds", type=int, default=12, help="cost factor of the password hashes")
+    parser.add_argument("--verifications", type=int, default=64, help="password checks of the pool measurement")
+    parser.add_argument("--admission", action="store_true", help="keep the per-user rate limits and in-flight limit on")
+    parser.add_argument("--output", help="write the report to this file instead of stdout")
+    args = parser.parse_args()
+
+    # The password cost, admission limits and stream timeout are read on import, so they have to be set first.
+    os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    os.environ["ADMISSION_ENABLED"] = "true" if args.admission else "false"
+    # An event stream is open for EVENT_STREAM_TIMEOUT by design; ending it after the retry line times its setup.
+    os.environ["EVENT_STREAM_TIMEOUT"] = "0"
+    from database.tables import Base, get_engine
+    from app import create_app
+
+    # Logging every statement would dominate the timings and mix with the report.
+    app = create_app({"DATABASE_URL": args.database, "DB_ECHO": "false"})
+    engine = get_engine()
+    sizes = dataset_sizes(args.users, args.courses, args.members, args.requests)
+    config = {"sizes": sizes._asdict(), "seed": args.seed, "iterations": args.iterations, "warmup": args.warmup,
+              "concurrency": args.concurrency, "threads": args.threads, "bcrypt_rounds": args.bcrypt_rounds,
+              "admission": args.admission, "database": engine.dialect.name,
+              "python": platform.python_version(), "sqlalchemy": sqlalchemy.__version__}
+
+    marker = (args.database.split(":///", 1)[-1] if engine.dialect.name == "sqlite" else "benchmark") + ".json"
+    seeded = {**sizes._asdict(), "seed": args.seed, "bcrypt_rounds": args.bcrypt_rounds,
+              "tables": {name: [column.name for column in table.columns] for name, table in Base.metadata.tables.items()}}
+    if args.reuse and os.path.exists(marker):
+        with open(marker) as stream:
+            args.reuse = json.load(stream) == seeded
+    if not args.reuse:
+        started = time.perf_counter()
+        seed(engine, sizes, random.Random(args.seed))
+        config["seed_seconds"] = round(time.perf_counter() - started, 1)
+        with open(marker, "w") as stream:
+            json.dump(seeded, stream)
+
+    fixtures = Fixtures(engine, sizes, random.Random(args.seed))
+    scenarios = scenario_calls(fixtures)
+    if args.only:
+        scenarios = {name: scenarios[name] for name in args.only}
+    counter = StatementCounter(engine)
+    report = {"config": config, "serialization": measure_serialization(engine, args.serialization_rows),
+              "passwords": measure_passwords(args.verifications)}
+
+    if args.mode in ("inprocess", "both"):
+        report["inprocess"] = run(InProcessClient(app), scenarios, counter, args, 1)
+
+    if args.mode in ("socket", "both"):
+        from waitress.server import create_server
+
+        logging.getLogger("waitress.queue").setLevel(logging.ERROR)
+        server = create_server(app, host="127.0.0.1", port=0, threads=args.threads)
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        try:
+            client = SocketClient("127.0.0.1", server.effective_port)
+            report["socket"] = run(client, scenarios, counter, args, args.concurrency)
+        finally:
+            server.close()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as stream:
+            stream.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire ``ttl`` seconds after being set.
+
+    ``generation`` is bumped by every invalidation. A reader that loaded a value from
+    the database passes the generation it saw before loading to ``set``, and the value
+    is dropped if an invalidation happened in between, so a slow reader can never put
+    back an entry that a concurrent write has just removed.
+
+    With ``sizeof``, the entries are also bounded by their total size: least recently used
+    entries are evicted until the sizes add up to at most ``maxbytes``.
+    """
+
+    def __init__(self, maxsize, ttl, maxbytes=0, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.generation = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at, size = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, generation=None):
+        if self.maxsize <= 0:
+            return
+        size = self.sizeof(value) if self.sizeof is not None else 0
+        if self.sizeof is not None and size > self.maxbytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._remove(key)
+            self._entries[key] = (value, time.monotonic() + self.ttl, size)
+            self.bytes += size
+            while len(self._entries) > self.maxsize or (self.sizeof is not None and self.bytes > self.maxbytes):
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.bytes = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Versions:
+    """Change counters that responses are versioned by.
+
+    ``catalog`` changes with any course or username, ``courses``/``users`` with a single course or with
+    the memberships and requests of a single user, and ``epoch`` invalidates everything.
+    """
+
+    def __init__(self):
+        self.epoch = 0
+        self.catalog = 0
+        self.courses = defaultdict(int)
+        self.users = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def bump_course(self, course_id):
+        with self._lock:
+            self.courses[course_id] += 1
+            self.catalog += 1
+
+    def bump_courses(self, *course_ids):
+        """Change single courses without changing the catalog, e.g. their counters."""
+        with self._lock:
+            for course_id in course_ids:
+                self.courses[course_id] += 1
+
+    def bump_catalog(self):
+        with self._lock:
+            self.catalog += 1
+
+    def bump_users(self, *user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self.users[user_id] += 1
+
+    def bump_all(self):
+        with self._lock:
+            self.epoch += 1
+
+    def course(self, course_id):
+        return self.courses.get(course_id, 0)
+
+    def user(self, user_id):
+        return self.users.get(user_id, 0)
+
+
+_boot_id = os.urandom(8).hex()
+
+
+def response_etag(*parts):
+    """Strong ETag for a response that is fully determined by ``parts``."""
+    return hashlib.sha1(repr((_boot_id,) + parts).encode()).hexdigest()
@@ -0,0 +1,34 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from database.counters import remove_pending
+from database.tables import Course, CourseMember, Request
+
+CASCADE_CHUNK_SIZE = int(os.environ.get("CASCADE_CHUNK_SIZE", 5000))
+CASCADE_WORKERS = int(os.environ.get("CASCADE_WORKERS", 1))
+
+logger = logging.getLogger("database.cascade")
+
+# background deletions run on a fixed pool so a burst of them cannot open a connection each
+executor = ThreadPoolExecutor(max_workers=CASCADE_WORKERS, thread_name_prefix="cascade")
+
+
+def delete_course_in_chunks(session, course_id, chunk_size=CASCADE_CHUNK_SIZE):
+    """Delete the memberships and requests of a course chunk by chunk, then the course itself.
+
+    Every chunk is committed on its own, so locks are held only briefly and an interrupted
+    deletion can simply be run again.
+    """
+    for table, key in ((CourseMember, CourseMember.courseId), (Request, Request.requestToCourse)):
+        while True:
+            ids = [row_id for row_id, in session.query(table.id).filter(key == course_id).limit(chunk_size)]
+            if not ids:
+                break
+            if table is Request:
+                remove_pending(session, Request.id.in_(ids))
+            session.query(table).filter(table.id.in_(ids)).delete(synchronize_session=False)
+            session.commit()
+    deleted = session.query(Course).filter(Course.id == course_id).delete(synchronize_session=False)
+    session.commit()
+    return deleted
@@ -0,0 +1,89 @@
+import argparse
+import json
+from collections import Counter
+
+from sqlalchemy import bindparam, case, func, select, update
+from sqlalchemy.orm import sessionmaker
+
+from database.tables import Course, CourseMember, Request, User, get_engine
+
+
+def count_members(session, course_ids, delta=1):
+    """Add ``delta`` to the member count of every course in ``course_ids`` (once per occurrence)."""
+    _apply(session, Course.memberCount, Course.id,
+           {course_id: count * delta for course_id, count in Counter(course_ids).items()})
+
+
+def count_pending(session, requests, delta=1):
+    """Add ``delta`` to the pending counts of the course and lector of every ``(course id, lector id)`` pair."""
+    _apply_pending(session, {pair: count * delta for pair, count in Counter(requests).items()})
+
+
+def remove_members(session, *criteria):
+    """Subtract the memberships matching ``criteria`` from the member counts, before they are deleted."""
+    _apply(session, Course.memberCount, Course.id, {course_id: -count for course_id, count in session.query(
+        CourseMember.courseId, func.count(CourseMember.id)).filter(*criteria).group_by(CourseMember.courseId)})
+
+
+def remove_pending(session, *criteria):
+    """Subtract the pending requests matching ``criteria`` from the pending counts, before they are deleted."""
+    _apply_pending(session, {(course_id, lector_id): -count for course_id, lector_id, count in session.query(
+        Request.requestToCourse, Request.requestToLector, func.count(Request.id)).filter(
+        Request.status == "OnHold", *criteria).group_by(Request.requestToCourse, Request.requestToLector)})
+
+
+def _apply_pending(session, deltas):
+    courses = Counter()
+    lectors = Counter()
+    for (course_id, lector_id), delta in deltas.items():
+        courses[course_id] += delta
+        lectors[lector_id] += delta
+    _apply(session, Course.pendingRequestCount, Course.id, courses)
+    _apply(session, User.pendingRequestCount, User.id, lectors)
+
+
+def _apply(session, column, key, deltas):
+    deltas = {row_id: delta for row_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    # one statement per counter, however many rows and different deltas there are
+    change = next(iter(deltas.values())) if len(set(deltas.values())) == 1 else case(deltas, value=key, else_=0)
+    session.execute(update(column.class_).where(key.in_(deltas)).values({column: column + change}).execution_options(
+        synchronize_session=False))
+
+
+def rebuild(session):
+    """Recompute every counter from the ``courseMember`` and ``request`` tables.
+
+    Counts are aggregated with one GROUP BY per counter and written back with executemany
+    updates, so the tables are scanned once instead of once per course or user.
+    """
+    courses = session.execute(update(Course).values(memberCount=0, pendingRequestCount=0)
+                              .execution_options(synchronize_session=False)).rowcount
+    users = session.execute(update(User).values(pendingRequestCount=0)
+                            .execution_options(synchronize_session=False)).rowcount
+    pending = Request.status == "OnHold"
+    for table, column, key, counts in (
+            (Course, "memberCount", CourseMember.courseId, select(CourseMember.courseId, func.count(CourseMember.id))
+             .group_by(CourseMember.courseId)),
+            (Course, "pendingRequestCount", Request.requestToCourse, select(Request.requestToCourse, func.count(Request.id))
+             .where(pending).group_by(Request.requestToCourse)),
+            (User, "pendingRequestCount", Request.requestToLector, select(Request.requestToLector, func.count(Request.id))
+             .where(pending).group_by(Request.requestToLector))):
+        rows = [{"row_id": row_id, "count": count} for row_id, count in session.execute(counts)]
+        if rows:
+            session.execute(update(table.__table__).where(table.__table__.c.id == bindparam("row_id"))
+                            .values({column: bindparam("count")}), rows)
+    session.commit()
+    return courses, users
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the member and pending request counters")
+    parser.parse_args()
+    courses, users = rebuild(sessionmaker(bind=get_engine())())
+    print(json.dumps({"courses": courses, "users": users}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import base64
+import json
+
+from sqlalchemy import and_, exists, or_
+from sqlalchemy.orm import aliased
+
+from database.tables import Course, CourseMember, Request, User
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+COURSE_SORT_KEYS = {"id": Course.id, "courseName": Course.courseName}
+REQUEST_SORT_KEYS = {"id": Request.id, "courseName": Course.courseName}
+REQUEST_STATUSES = ("OnHold", "Accepted", "Declined")
+
+Student = aliased(User)
+
+
+def course_rows(session):
+    return session.query(Course.id, Course.courseName, Course.courseDescription,
+                         User.username.label("lectorUsername")).join(User, User.id == Course.courseLector)
+
+
+def lector_courses(session, lector_id):
+    return course_rows(session).add_columns(Course.memberCount, Course.pendingRequestCount).filter(
+        Course.courseLector == lector_id)
+
+
+def student_courses(session, user_id):
+    return course_rows(session).join(CourseMember, CourseMember.courseId == Course.id).filter(
+        CourseMember.userId == user_id)
+
+
+def available_courses(session, user_id):
+    is_member = exists().where(and_(CourseMember.courseId == Course.id, CourseMember.userId == user_id))
+    is_declined = exists().where(and_(Request.requestToCourse == Course.id, Request.studentId == user_id,
+                                      Request.status == "Declined"))
+    return course_rows(session).add_columns(is_declined.label("declined")).filter(~is_member)
+
+
+def lector_requests(session, lector_id):
+    return session.query(Request.id, Course.courseName, Student.username.label("studentName")).join(
+        Course, Course.id == Request.requestToCourse).join(Student, Student.id == Request.studentId).filter(
+        Request.requestToLector == lector_id)
+
+
+def request_targets(session, student_id, course_id):
+    """Lector of the course and the user types of the lector and the student, in one query."""
+    lector = aliased(User)
+    return session.query(Course.courseLector, lector.userType.label("lectorType"),
+                         Student.userType.label("studentType")).outerjoin(
+        lector, lector.id == Course.courseLector).outerjoin(Student, Student.id == student_id).filter(
+        Course.id == course_id)
+
+
+def filter_courses(query, args):
+    if args.get("lector"):
+        query = query.filter(User.username == args["lector"])
+    if args.get("name"):
+        query = query.filter(Course.courseName.like(_escape_like(args["name"]) + "%", escape="\\"))
+    return query
+
+
+def filter_requests(query, args):
+    status = args.get("status", "OnHold")
+    if status not in REQUEST_STATUSES:
+        raise ValueError(f"status must be one of {', '.join(REQUEST_STATUSES)}")
+    query = query.filter(Request.status == status)
+    if args.get("name"):
+        query = query.filter(Course.courseName.like(_escape_like(args["name"]) + "%", escape="\\"))
+    return query
+
+
+def paginate(query, args, sort_keys, id_column):
+    """Return one keyset page of ``query`` and the cursor of the next page.
+
+    Pages are ordered by the ``sort`` argument (``-`` prefix for descending) with
+    ``id_column`` as tie-breaker, and the cursor holds the last row's sort value and id,
+    so every page is an index seek no matter how deep it is.
+    """
+    limit = page_limit(args)
+    sort = args.get("sort", "id")
+    descending = sort.startswith("-")
+    sort_key = sort.lstrip("-")
+    if sort_key not in sort_keys:
+        raise ValueError(f"sort must be one of {', '.join(sort_keys)}")
+    sort_column = sort_keys[sort_key]
+
+    if args.get("cursor"):
+        value, last_id = decode_cursor(args["cursor"], sort_column.type.python_type)
+        if sort_column is id_column:
+            query = query.filter(id_column < last_id if descending else id_column > last_id)
+        elif descending:
+            query = query.filter(or_(sort_column < value, and_(sort_column == value, id_column < last_id)))
+        else:
+            query = query.filter(or_(sort_column > value, and_(sort_column == value, id_column > last_id)))
+
+    if descending:
+        order = [sort_column.desc()] if sort_column is id_column else [sort_column.desc(), id_column.desc()]
+    else:
+        order = [sort_column] if sort_column is id_column else [sort_column, id_column]
+    rows = query.order_by(*order).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(getattr(rows[-1], sort_key), rows[-1].id)
+    return rows, next_cursor
+
+
+def page_limit(args):
+    try:
+        limit = int(args.get("limit", DEFAULT_LIMIT))
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if not 1 <= limit <= MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+    return limit
+
+
+def encode_cursor(value, last_id):
+    return base64.urlsafe_b64encode(json.dumps([value, last_id]).encode()).decode()
+
+
+def decode_cursor(cursor, value_type):
+    """Return the ``(value, last id)`` of ``cursor``, whose value must be a ``value_type``."""
+    try:
+        value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not _is_instance(value, value_type) or not _is_instance(last_id, int):
+        raise ValueError("Invalid cursor")
+    return value, last_id
+
+
+def _is_instance(value, value_type):
+    # JSON true and false decode to bools, which are ints to isinstance
+    return isinstance(value, value_type) and not isinstance(value, bool)
+
+
+def page_to_dict(rows, next_cursor, schema):
+    return {"items": schema.dump(rows, many=True), "next_cursor": next_cursor}
+
+
+def _escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
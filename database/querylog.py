@@ -0,0 +1,155 @@
+import atexit
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+
+from sqlalchemy import event
+
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 100))
+QUERY_SAMPLE_RATE = float(os.environ.get("QUERY_SAMPLE_RATE", 0))
+QUERY_EXPLAIN_TOP = int(os.environ.get("QUERY_EXPLAIN_TOP", 0))
+MAX_FINGERPRINTS = 1000
+
+STRING = re.compile(r"'(?:[^']|'')*'")
+NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+PLACEHOLDER = re.compile(r"%\(\w+\)s|%s|(?<![:\w]):\w+|\?")
+PLACEHOLDER_LIST = re.compile(r"\(\?(?:\s*,\s*\?)+\)")
+WHITESPACE = re.compile(r"\s+")
+
+logger = logging.getLogger("database.querylog")
+
+
+@lru_cache(maxsize=4096)
+def fingerprint(statement):
+    """Normalize ``statement`` so that executions differing only in their parameters have the same text."""
+    statement = STRING.sub("?", statement)
+    statement = NUMBER.sub("?", statement)
+    statement = PLACEHOLDER.sub("?", statement)
+    statement = PLACEHOLDER_LIST.sub("(?+)", statement)
+    return WHITESPACE.sub(" ", statement).strip()
+
+
+class QueryStats:
+    """Execution count and time per statement fingerprint."""
+
+    def __init__(self):
+        self.fingerprints = {}
+        self.explained = set()
+        self._lock = threading.Lock()
+
+    def add(self, statement, elapsed):
+        with self._lock:
+            if statement not in self.fingerprints and len(self.fingerprints) >= MAX_FINGERPRINTS:
+                statement = "other"
+            entry = self.fingerprints.setdefault(statement, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+            return entry[2]
+
+    def should_explain(self, statement, slowest):
+        """Claim ``statement`` for EXPLAIN once it is one of the ``QUERY_EXPLAIN_TOP`` slowest fingerprints."""
+        with self._lock:
+            if statement in self.explained or len(self.explained) >= QUERY_EXPLAIN_TOP:
+                return False
+            if sum(entry[2] > slowest for entry in self.fingerprints.values()) >= QUERY_EXPLAIN_TOP:
+                return False
+            self.explained.add(statement)
+            return True
+
+    def top(self, count=20):
+        with self._lock:
+            return sorted(self.fingerprints.items(), key=lambda item: -item[1][1])[:count]
+
+    def render(self):
+        lines = ["# HELP db_query_seconds_total Time spent per statement fingerprint.",
+                 "# TYPE db_query_seconds_total counter"]
+        top = self.top(len(self.fingerprints))
+        for statement, (_, total, _) in top:
+            lines.append(f'db_query_seconds_total{{fingerprint="{_escape(statement)}"}} {total}')
+        lines.extend(["# HELP db_queries_total Executions per statement fingerprint.", "# TYPE db_queries_total counter"])
+        for statement, (executions, _, _) in top:
+            lines.append(f'db_queries_total{{fingerprint="{_escape(statement)}"}} {executions}')
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self.fingerprints.clear()
+            self.explained.clear()
+
+
+query_stats = QueryStats()
+
+
+class ExplainHandler(logging.Handler):
+    """Runs EXPLAIN for the records that ask for it, on the listener thread instead of the request thread.
+
+    The plan comes from the engine that ran the statement, so a query on a replica is explained on that replica.
+    """
+
+    def emit(self, record):
+        statement = getattr(record, "explain", None)
+        if statement is None:
+            return
+        engine = record.engine
+        prefix = "EXPLAIN QUERY PLAN " if engine.dialect.name == "sqlite" else "EXPLAIN "
+        try:
+            with engine.connect() as connection:
+                plan = connection.exec_driver_sql(prefix + statement, record.parameters).fetchall()
+        except Exception as err:
+            logger.warning("EXPLAIN failed for %s: %s", record.fingerprint, err)
+            return
+        logger.warning("EXPLAIN %s\n%s", record.fingerprint, "\n".join(" | ".join(map(str, row)) for row in plan))
+
+
+def install(engine):
+    """Log slow and sampled statements of ``engine`` and aggregate them per fingerprint.
+
+    Records go through a queue to a listener thread, so the request threads never wait on I/O.
+    """
+    if event.contains(engine, "after_cursor_execute", after_cursor_execute):
+        return
+    if not logger.handlers:
+        records = queue.SimpleQueue()
+        output = logging.StreamHandler()
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+        listener = QueueListener(records, output, ExplainHandler())
+        listener.start()
+        atexit.register(listener.stop)
+        logger.addHandler(QueueHandler(records))
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("querylog_started", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["querylog_started"].pop()
+    normalized = fingerprint(statement)
+    if normalized.startswith("EXPLAIN"):
+        return
+    slowest = query_stats.add(normalized, elapsed)
+    milliseconds = elapsed * 1000
+    if milliseconds >= SLOW_QUERY_MS:
+        extra = {}
+        # the connections of an async engine can only be used from its event loop, not from the listener thread
+        if QUERY_EXPLAIN_TOP and not executemany and not conn.dialect.is_async and \
+                normalized.upper().startswith("SELECT") and query_stats.should_explain(normalized, slowest):
+            extra = {"explain": statement, "parameters": parameters, "fingerprint": normalized, "engine": conn.engine}
+        logger.warning("slow query %.1f ms: %s", milliseconds, statement, extra=extra)
+    elif QUERY_SAMPLE_RATE and random.random() < QUERY_SAMPLE_RATE:
+        logger.info("query %.1f ms: %s", milliseconds, normalized)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
@@ -0,0 +1,119 @@
+import itertools
+import os
+import threading
+import time
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.dml import UpdateBase
+
+from database.tables import get_engine
+
+REPLICA_RETRY_SECONDS = float(os.environ.get("REPLICA_RETRY_SECONDS", 5))
+REPLICA_MAX_LAG = float(os.environ.get("REPLICA_MAX_LAG", 1))
+
+
+class ReplicaPool:
+    """Replica engines handed out round-robin, skipping the ones that failed until they answer again.
+
+    ``engines`` may also be a function returning them, which is only called when a replica is first needed.
+    """
+
+    def __init__(self, engines=()):
+        self.source = engines
+        self.down_until = {}
+        self.last_write = float("-inf")
+        self._engines = None
+        self._position = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def engines(self):
+        if self._engines is None:
+            engines = list(self.source() if callable(self.source) else self.source)
+            for engine in engines:
+                if not event.contains(engine, "handle_error", self._handle_error):
+                    event.listen(engine, "handle_error", self._handle_error)
+            self._engines = engines
+        return self._engines
+
+    def reset(self):
+        """Load the engines again on next use, e.g. after the database was reconfigured."""
+        self._engines = None
+        self.down_until.clear()
+
+    def add(self, engine):
+        if not event.contains(engine, "handle_error", self._handle_error):
+            event.listen(engine, "handle_error", self._handle_error)
+        self.engines.append(engine)
+
+    def remove(self, engine):
+        event.remove(engine, "handle_error", self._handle_error)
+        self.engines.remove(engine)
+        self.down_until.pop(engine, None)
+
+    def next(self):
+        """Return the next healthy replica, or None when the primary has to serve the reads."""
+        engines = self.engines
+        for _ in range(len(engines)):
+            with self._lock:
+                engine = engines[next(self._position) % len(engines)]
+            until = self.down_until.get(engine)
+            if until is None or (time.monotonic() >= until and self.probe(engine)):
+                return engine
+        return None
+
+    def probe(self, engine):
+        try:
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+        except Exception:
+            self.mark_down(engine)
+            return False
+        self.down_until.pop(engine, None)
+        return True
+
+    def mark_down(self, engine):
+        self.down_until[engine] = time.monotonic() + REPLICA_RETRY_SECONDS
+
+    def wrote(self):
+        self.last_write = time.monotonic()
+
+    def lagging(self):
+        """Whether replicas may not have caught up with the last write of this process yet."""
+        return time.monotonic() - self.last_write < REPLICA_MAX_LAG
+
+    def _handle_error(self, context):
+        if context.is_disconnect:
+            self.mark_down(context.engine)
+
+
+class RoutingSession(Session):
+    """Sends reads to a replica while ``info["replica"]`` is set and everything else to the primary.
+
+    The first write pins the session to the primary, so a request reads its own writes.
+    One replica is used for all reads of a session, so they see the same snapshot.
+    """
+
+    def __init__(self, replicas=None, **kwargs):
+        if kwargs.get("bind") is None and not kwargs.get("binds"):
+            kwargs["bind"] = get_engine()
+        super().__init__(**kwargs)
+        self.replicas = replicas
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        primary = super().get_bind(mapper, clause, **kwargs)
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info["wrote"] = True
+            if self.replicas is not None:
+                self.replicas.wrote()
+            return primary
+        if self.replicas is None or not self.info.get("replica") or self.info.get("wrote"):
+            return primary
+        if "replica_engine" not in self.info:
+            self.info["replica_engine"] = self.replicas.next()
+        return self.info["replica_engine"] or primary
+
+    def may_be_stale(self):
+        """Whether reads may have come from a replica that has not caught up with the last write yet."""
+        return self.info.get("replica_engine") is not None and self.replicas.lagging()
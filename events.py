@@ -0,0 +1,119 @@
+import asyncio
+import json
+import os
+import threading
+from collections import deque, namedtuple
+from itertools import islice
+
+EVENT_HISTORY = int(os.environ.get("EVENT_HISTORY", 10000))
+EVENT_STREAM_TIMEOUT = float(os.environ.get("EVENT_STREAM_TIMEOUT", 30))
+EVENT_HEARTBEAT = float(os.environ.get("EVENT_HEARTBEAT", 15))
+EVENT_RETRY_MS = int(os.environ.get("EVENT_RETRY_MS", 3000))
+# half of the 8 threads the README serves the WSGI app with, so streams can not starve the other requests
+EVENT_MAX_STREAMS = int(os.environ.get("EVENT_MAX_STREAMS", 4))
+
+Event = namedtuple("Event", ["id", "type", "data", "users"])
+
+
+class EventBus:
+    """In-process publish/subscribe of events addressed to a set of users.
+
+    Event ids are consecutive, and the last ``history`` events are kept so a subscriber that
+    reconnects with the id of the last event it saw gets the events it missed. ``since`` returns
+    None instead when those events were already dropped or the id is from another process.
+    """
+
+    def __init__(self, history):
+        self.last_id = 0
+        self.streams = 0
+        self._events = deque(maxlen=history)
+        self._condition = threading.Condition()
+        self._async_waiters = set()
+
+    def publish(self, type, data, users):
+        with self._condition:
+            self.last_id += 1
+            self._events.append(Event(self.last_id, type, data, frozenset(users)))
+            self._condition.notify_all()
+            waiters = list(self._async_waiters)
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def since(self, user_id, last_id):
+        """The events of ``user_id`` after ``last_id``, and the id they are up to date with."""
+        with self._condition:
+            first_id = self._events[0].id if self._events else self.last_id + 1
+            if last_id > self.last_id or last_id + 1 < first_id:
+                return None, self.last_id
+            events = [event for event in islice(self._events, last_id + 1 - first_id, None) if user_id in event.users]
+            return events, self.last_id
+
+    def wait(self, user_id, last_id, timeout):
+        with self._condition:
+            self._condition.wait_for(lambda: self.last_id != last_id, timeout)
+        return self.since(user_id, last_id)
+
+    async def wait_async(self, user_id, last_id, timeout):
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._condition:
+            waiting = self.last_id == last_id
+            if waiting:
+                self._async_waiters.add(waiter)
+        try:
+            if waiting:
+                await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._condition:
+                self._async_waiters.discard(waiter)
+        return self.since(user_id, last_id)
+
+    def open_stream(self, limit):
+        with self._condition:
+            if 0 < limit <= self.streams:
+                return False
+            self.streams += 1
+            return True
+
+    def close_stream(self):
+        with self._condition:
+            self.streams -= 1
+
+    def clear(self):
+        with self._condition:
+            self._events.clear()
+
+
+def format_event(event):
+    return f"id: {event.id}\nevent: {event.type}\ndata: {json.dumps(event.data)}\n\n"
+
+
+def stream_chunks(events, last_id, position):
+    """The SSE messages for one wake-up of a subscriber that had seen ``last_id``.
+
+    ``events`` is None when the missed events are gone, which tells the client to reload instead.
+    A bare ``id`` moves the client's Last-Event-ID past events addressed to other users.
+    """
+    if events is None:
+        return [f"id: {position}\nevent: reset\ndata: {{}}\n\n"]
+    chunks = [format_event(event) for event in events]
+    if position != last_id and (not events or events[-1].id != position):
+        chunks.append(f"id: {position}\n\n")
+    return chunks or [": keepalive\n\n"]
+
+
+def last_event_id(value, default):
+    try:
+        return int(value) if value is not None else default
+    except ValueError:
+        return default
+
+
+def request_event(req, status=None):
+    data = {"id": req.id, "studentId": req.studentId, "requestToCourse": req.requestToCourse,
+            "requestToLector": req.requestToLector, "status": status or req.status}
+    return "request", data, (req.studentId, req.requestToLector)
+
+
+bus = EventBus(EVENT_HISTORY)
@@ -0,0 +1,60 @@
+import csv
+import io
+import json
+
+from sqlalchemy import select
+
+from database.tables import *
+
+BATCH_SIZE = 1000
+MIMETYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def export_courses(lector_id):
+    return select(Course.id, Course.courseName, Course.courseDescription, Course.courseLector,
+                  User.username.label("lectorUsername")).join(User, User.id == Course.courseLector).order_by(Course.id)
+
+
+def export_course_members(lector_id):
+    return select(CourseMember.id, CourseMember.courseId, CourseMember.userId,
+                  User.username.label("username")).join(User, User.id == CourseMember.userId).join(
+        Course, Course.id == CourseMember.courseId).filter(Course.courseLector == lector_id).order_by(CourseMember.id)
+
+
+def export_requests(lector_id):
+    return select(Request.id, Request.studentId, Request.requestToCourse, Request.requestToLector,
+                  Request.status).filter(Request.requestToLector == lector_id).order_by(Request.id)
+
+
+EXPORTS = {
+    "courses": export_courses,
+    "members": export_course_members,
+    "requests": export_requests,
+}
+
+
+def stream_batches(session, kind, lector_id, batch_size=BATCH_SIZE):
+    """Iterate over the rows of an export with a server-side cursor, ``batch_size`` rows at a time."""
+    result = session.execute(EXPORTS[kind](lector_id), execution_options={"stream_results": True})
+    return result.partitions(batch_size)
+
+
+def format_ndjson(rows, first):
+    return "".join(json.dumps(row._asdict()) + "\n" for row in rows)
+
+
+def format_csv(rows, first):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if first:
+        writer.writerow(rows[0]._fields)
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+
+FORMATTERS = {"ndjson": format_ndjson, "csv": format_csv}
+
+
+def write_batches(batches, fmt):
+    for number, rows in enumerate(batches):
+        yield FORMATTERS[fmt](rows, number == 0)
@@ -0,0 +1,608 @@
+"""Request handling shared by the WSGI app in ``routes.py`` and the ASGI app in ``asgi.py``.
+
+Handlers take a synchronous session and the already parsed request data and return ``(body, status)``.
+``routes.py`` calls them with its request-scoped session and ``asgi.py`` through ``AsyncSession.run_sync``;
+the callables they take for bcrypt let the async app wait for the password pool without blocking its loop.
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import logging
+import math
+import os
+from collections import namedtuple
+
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from marshmallow import ValidationError
+from sqlalchemy import insert, or_, tuple_
+from sqlalchemy.exc import IntegrityError
+
+from database.tables import Course, CourseMember, Request, User
+from database.querylog import query_stats
+from database.counters import count_members, count_pending, remove_members, remove_pending
+from database.listing import *
+from schema import *
+from cache import TTLCache, Versions
+from importer import FORMATS, IMPORTS, import_rows, read_rows
+from exporter import EXPORTS, FORMATTERS
+from search import course_index, search_courses
+from metrics import metrics
+from passwords import check_password, hash_password, needs_rehash
+from admission import admission
+from events import bus, request_event
+
+PRIMARY_HEADER = "X-Read-From-Primary"
+
+logger = logging.getLogger(__name__)
+
+Principal = namedtuple("Principal", ["id", "username", "userType"])
+
+principals = TTLCache(int(os.environ.get("AUTH_CACHE_SIZE", 10000)), int(os.environ.get("AUTH_CACHE_TTL", 300)))
+_credential_key = os.urandom(32)
+
+TOKEN_TTL = int(os.environ.get("TOKEN_TTL", 3600))
+if not os.environ.get("SECRET_KEY"):
+    logger.warning("SECRET_KEY is not set: tokens are signed with a random key, so they are only accepted by this "
+                   "process and stop working when it restarts")
+tokens = URLSafeTimedSerializer(os.environ.get("SECRET_KEY") or os.urandom(32), salt="auth-token")
+token_versions = TTLCache(int(os.environ.get("AUTH_CACHE_SIZE", 10000)), int(os.environ.get("TOKEN_VERSION_CACHE_TTL", 60)))
+
+memberships = TTLCache(int(os.environ.get("MEMBERSHIP_CACHE_SIZE", 10000)),
+                       int(os.environ.get("MEMBERSHIP_CACHE_TTL", 300)))
+
+# entries are (body, mimetype), bounded by the bytes of their bodies as pages can be large
+responses = TTLCache(int(os.environ.get("RESPONSE_CACHE_SIZE", 10000)), int(os.environ.get("RESPONSE_CACHE_TTL", 300)),
+                     int(os.environ.get("RESPONSE_CACHE_BYTES", 64 * 1024 * 1024)), lambda entry: len(entry[0]))
+versions = Versions()
+active_request_key = next(constraint for constraint in Request.__table__.constraints
+                          if constraint.name == "uq_request_activeStudentId_requestToCourse")
+
+
+def reads_from_replica(method, headers):
+    return method == "GET" and headers.get(PRIMARY_HEADER, "false").lower() != "true"
+
+
+def admission_key(authorization, remote_addr):
+    """The bucket key of a request: its user when the credentials check out without a database round trip,
+    otherwise its client address."""
+    scheme, _, credentials = authorization.partition(" ")
+    if scheme.lower() == "bearer":
+        try:
+            return f"user:{tokens.loads(credentials, max_age=TOKEN_TTL)['id']}"
+        except BadSignature:
+            pass
+    elif scheme.lower() == "basic":
+        try:
+            username, _, password = base64.b64decode(credentials).decode("utf-8").partition(":")
+        except (binascii.Error, ValueError):
+            username, password = None, ""
+        cached = principals.get(username) if username else None
+        if cached is not None and hmac.compare_digest(cached[0], credential_digest(password)):
+            return f"user:{cached[1].id}"
+    return f"addr:{remote_addr}"
+
+
+def admission_refusal(status, retry_after):
+    message = "Too many requests." if status == 429 else "Server is busy."
+    return {"message": message}, status, {"Retry-After": str(math.ceil(retry_after))}
+
+
+def credential_digest(password):
+    return hmac.new(_credential_key, password.encode(), hashlib.sha256).digest()
+
+
+def verify_password(session, username, password, check=check_password, rehash=hash_password):
+    digest = credential_digest(password)
+    cached = principals.get(username)
+    if cached is not None and hmac.compare_digest(cached[0], digest):
+        return cached[1]
+
+    generation = principals.generation
+    user = session.query(User).filter(User.username == username).one_or_none()
+    if user is None:
+        return False
+
+    if not check(password, user.password):
+        return False
+    if needs_rehash(user.password):
+        user.password = rehash(password)
+        session.commit()
+
+    principal = Principal(user.id, user.username, user.userType)
+    principals.set(username, (digest, principal), generation)
+    return principal
+
+
+def token_version(session, user_id):
+    version = token_versions.get(user_id)
+    if version is None:
+        generation = token_versions.generation
+        version = session.query(User.tokenVersion).filter(User.id == user_id).scalar()
+        if version is not None:
+            token_versions.set(user_id, version, generation)
+    return version
+
+
+def issue_token(session, principal):
+    token = tokens.dumps({"id": principal.id, "username": principal.username, "userType": principal.userType,
+                          "version": token_version(session, principal.id)})
+    return {"token": token, "expires_in": TOKEN_TTL}
+
+
+def revoke_tokens(user):
+    user.tokenVersion = User.tokenVersion + 1
+
+
+def verify_token(session, token):
+    try:
+        data = tokens.loads(token, max_age=TOKEN_TTL)
+    except BadSignature:
+        return False
+    if token_version(session, data["id"]) != data["version"]:
+        return False
+    return Principal(data["id"], data["username"], data["userType"])
+
+
+def permission_error(principal, permission):
+    if principal.userType != permission:
+        return {"message": "Forbidden"}, 403
+    return None
+
+
+def request_target_error(target):
+    if target is None:
+        return {"message": "Course could not be found."}, 404
+    if target.lectorType is None:
+        return {"message": "Lector could not be found."}, 404
+    if target.lectorType != 'Lector':
+        return {"message": "This user is not a lector."}, 406
+    if target.studentType is None:
+        return {"message": "Student could not be found."}, 404
+    if target.studentType != 'Student':
+        return {"message": "This user is not a student."}, 406
+    return None
+
+
+def is_duplicate(err, constraint):
+    """Whether ``err`` violates the unique ``constraint``, going by the driver's error code and key name."""
+    orig = err.orig
+    if getattr(orig, "pgcode", None) is not None:
+        return orig.pgcode == "23505" and orig.diag.constraint_name == constraint.name
+    args = getattr(orig, "args", ())
+    if len(args) == 2 and args[0] == 1062:
+        # MySQL: Duplicate entry '...' for key '[table.]name'
+        return str(args[1]).endswith((f"'{constraint.name}'", f".{constraint.name}'"))
+    # SQLite names the columns of the key instead of the key
+    columns = ", ".join(f"{constraint.table.name}.{column.name}" for column in constraint.columns)
+    return str(orig) == f"UNIQUE constraint failed: {columns}"
+
+
+def member_courses(session, user_id):
+    """Ids of the courses ``user_id`` is a member of, cached per user."""
+    courses = memberships.get(user_id)
+    if courses is None:
+        generation = memberships.generation
+        courses = frozenset(course_id for course_id, in session.query(CourseMember.courseId).filter(
+            CourseMember.userId == user_id))
+        if not session.may_be_stale():
+            memberships.set(user_id, courses, generation)
+    return courses
+
+
+# the course and request pages show course names and usernames, and a change to either bumps the catalog
+def catalog_version(user_id, **kwargs):
+    return versions.catalog, versions.user(user_id)
+
+
+def course_version(user_id, course_id):
+    return versions.course(course_id), versions.user(user_id)
+
+
+def metrics_text():
+    return metrics.render() + query_stats.render() + admission.render()
+
+
+def get_user(session, principal, username):
+    user = session.query(User).filter(User.username == username).first()
+    if user is None:
+        return {"message": "User could not be found."}, 404
+    if principal.id != user.id:
+        return {"message": "Forbidden"}, 403
+    schema = get_schema(UserSchema)
+    return schema.dump(user), 200
+
+
+def update_user(session, principal, username, params, rehash=hash_password):
+    user = session.query(User).filter(User.username == username).first()
+    if user is None:
+        return {"message": "User could not be found."}, 404
+    if principal.id != user.id:
+        return {"message": "Forbidden"}, 403
+    if not params:
+        return {"message": "No input data provided"}, 400
+    if 'id' in params:
+        return {"message": "You can not change id"}, 400
+    for field in ('tokenVersion', 'pendingRequestCount'):
+        if field in params:
+            return {"message": f"You can not change {field}"}, 400
+    errors = get_schema(UserSchema).validate(params, partial=True)
+    if errors:
+        return errors, 422
+    new_username = params.get('username')
+    if new_username is not None and new_username != username and \
+            session.query(User.id).filter(User.username == new_username).first() is not None:
+        return {"message": "User with provided username already exists"}, 406
+    for key, value in params.items():
+        setattr(user, key, value)
+    if 'password' in params:
+        user.password = rehash(params['password'])
+    if {'username', 'password', 'userType'} & params.keys():
+        revoke_tokens(user)
+    session.commit()
+    principals.invalidate(username, new_username)
+    token_versions.invalidate(principal.id)
+    if 'username' in params:
+        versions.bump_catalog()
+    versions.bump_users(principal.id)
+    return params, 200
+
+
+def delete_user(session, principal, username):
+    user = session.query(User).filter(User.username == username).first()
+    if user is None:
+        return {"message": "User could not be found."}, 404
+    if principal.id != user.id:
+        return {"message": "Forbidden"}, 403
+    remove_members(session, CourseMember.userId == user.id)
+    remove_pending(session, or_(Request.studentId == user.id, Request.requestToLector == user.id))
+    session.query(Request).filter(Request.studentId == user.id).delete(synchronize_session=False)
+    # memberships and the requests to the user are removed by ON DELETE CASCADE
+    session.delete(user)
+    session.commit()
+    principals.invalidate(username)
+    token_versions.invalidate(principal.id)
+    memberships.invalidate(user.id)
+    versions.bump_all()
+    schema = get_schema(UserSchema)
+    return schema.dump(user), 200
+
+
+def settle_pending(session, requests, accept):
+    """Accept (delete) or decline those of the ``requests`` rows that are still on hold, in one statement.
+
+    The rows are locked first, so a request handled by a concurrent transaction in the meantime is
+    neither settled nor taken off the pending counts twice. Returns the ids of the settled requests.
+    """
+    pending = {request_id for request_id, in session.query(Request.id).filter(
+        Request.id.in_([req.id for req in requests]), Request.status == 'OnHold').with_for_update()}
+    if not pending:
+        return pending
+    settled = session.query(Request).filter(Request.id.in_(pending))
+    if accept:
+        settled.delete(synchronize_session=False)
+    else:
+        settled.update({"status": "Declined"}, synchronize_session=False)
+    count_pending(session, [(req.requestToCourse, req.requestToLector) for req in requests if req.id in pending], -1)
+    return pending
+
+
+def request_row(session, request_id):
+    return session.query(Request.id, Request.studentId, Request.requestToCourse, Request.requestToLector).filter(
+        Request.id == request_id).first()
+
+
+def accept_request(session, request_id):
+    req = request_row(session, request_id)
+    if req is None:
+        return {"message": "Request could not be found."}, 404
+    if not settle_pending(session, [req], accept=True):
+        # declined before, or accepted by a concurrent request since it was read
+        if not session.query(Request).filter(Request.id == request_id).delete(synchronize_session=False):
+            session.rollback()
+            return {"message": "Request could not be found."}, 404
+    if session.query(CourseMember.id).filter(CourseMember.courseId == req.requestToCourse).filter(
+            CourseMember.userId == req.studentId).first() is None:
+        new_course_member = CourseMember(courseId=req.requestToCourse, userId=req.studentId)
+        session.add(new_course_member)
+        count_members(session, [req.requestToCourse])
+    event = request_event(req, "Accepted")
+    session.commit()
+    bus.publish(*event)
+    memberships.invalidate(req.studentId)
+    versions.bump_users(req.studentId, req.requestToLector)
+    versions.bump_courses(req.requestToCourse)
+    return {"message": "Accepted"}, 200
+
+
+def decline_request(session, request_id):
+    req = request_row(session, request_id)
+    if req is None:
+        return {"message": "Request could not be found."}, 404
+    if not settle_pending(session, [req], accept=False) and \
+            request_row(session, request_id) is None:
+        # accepted by a concurrent request since it was read
+        session.rollback()
+        return {"message": "Request could not be found."}, 404
+    event = request_event(req, "Declined")
+    session.commit()
+    bus.publish(*event)
+    versions.bump_users(req.studentId, req.requestToLector)
+    versions.bump_courses(req.requestToCourse)
+    return {"message": "Declined"}, 200
+
+
+def handle_requests(session, principal, params):
+    if not params:
+        return {"message": "No input data provided"}, 400
+    try:
+        data = get_schema(RequestActionSchema).load(params)
+    except ValidationError as err:
+        return err.messages, 422
+    ids = list(dict.fromkeys(data['ids']))
+    found = {req.id: req for req in session.query(Request.id, Request.studentId, Request.requestToCourse,
+                                                   Request.requestToLector, Request.status).filter(Request.id.in_(ids))}
+    lector_id = principal.id
+    owned = [request_id for request_id in ids
+             if request_id in found and found[request_id].requestToLector == lector_id]
+    accept = data['action'] == 'accept'
+
+    if owned and accept:
+        pairs = {(found[request_id].requestToCourse, found[request_id].studentId) for request_id in owned}
+        existing = set(session.query(CourseMember.courseId, CourseMember.userId).filter(
+            tuple_(CourseMember.courseId, CourseMember.userId).in_(pairs)))
+        new_members = [{"courseId": course_id, "userId": user_id} for course_id, user_id in pairs - existing]
+        if new_members:
+            session.execute(insert(CourseMember), new_members)
+            count_members(session, [member["courseId"] for member in new_members])
+    settled = settle_pending(session, [found[request_id] for request_id in owned], accept) if owned else set()
+    if accept and len(settled) < len(owned):
+        # requests that were declined before leave the pending counts alone
+        session.query(Request).filter(Request.id.in_(owned)).delete(synchronize_session=False)
+    session.commit()
+    done = "Accepted" if accept else "Declined"
+    for request_id in owned:
+        bus.publish(*request_event(found[request_id], done))
+    if accept:
+        memberships.invalidate(*{found[request_id].studentId for request_id in owned})
+    versions.bump_users(lector_id, *{found[request_id].studentId for request_id in owned})
+    versions.bump_courses(*{found[request_id].requestToCourse for request_id in owned})
+
+    results = []
+    for request_id in ids:
+        if request_id not in found:
+            results.append({"id": request_id, "code": 404, "message": "Request could not be found."})
+        elif found[request_id].requestToLector != lector_id:
+            results.append({"id": request_id, "code": 403, "message": "Forbidden"})
+        else:
+            results.append({"id": request_id, "code": 200, "message": done})
+    return results, 200
+
+
+def add_course(session, params):
+    if not params:
+        return {"message": "No input data provided"}, 400
+    if 'id' in params:
+        return {"message": "You can not change id"}, 400
+    schema = get_schema(CourseSchema)
+    try:
+        data = schema.load(params)
+    except ValidationError as err:
+        return err.messages, 422
+    user_lector = session.get(User, data.courseLector)
+    if user_lector is None:
+        return {"message": "User could not be found."}, 404
+    if user_lector.userType != 'Lector':
+        return {"message": "This user is not lector."}, 406
+    session.add(data)
+    session.commit()
+    course_index.add(data.id, data.courseName, data.courseDescription)
+    versions.bump_course(data.id)
+    return schema.dump(data), 200
+
+
+def get_course(session, principal, course_id):
+    course = session.get(Course, course_id)
+    if course is None:
+        return {"message": "Course could not be found."}, 404
+    if course.courseLector != principal.id and course_id not in member_courses(session, principal.id):
+        return {"message": "Forbidden"}, 403
+    schema = get_schema(CourseSchema)
+    return schema.dump(course), 200
+
+
+def user_courses(session, principal):
+    """The unpaginated course list of the old API, 404 when the lector has no course."""
+    courses = lector_courses(session, principal.id).order_by(Course.id).all()
+    if not courses:
+        return {"message": "Courses could not be found."}, 404
+    return get_schema(CourseItemSchema, many=True).dump(courses), 200
+
+
+def course_page(session, courses_of, principal, args):
+    try:
+        rows, next_cursor = paginate(filter_courses(courses_of(session, principal.id), args), args,
+                                     COURSE_SORT_KEYS, Course.id)
+    except ValueError as err:
+        return {"message": str(err)}, 400
+    return page_to_dict(rows, next_cursor, get_schema(CourseItemSchema)), 200
+
+
+def search_course(session, args):
+    text = args.get('q', '').strip()
+    if not text:
+        return {"message": "q must not be empty"}, 400
+    try:
+        limit = page_limit(args)
+        offset = 0
+        if args.get('cursor'):
+            cursor_text, offset = decode_cursor(args['cursor'], str)
+            if cursor_text != text or offset < 0:
+                raise ValueError("Invalid cursor")
+    except ValueError as err:
+        return {"message": str(err)}, 400
+    rows, has_more = search_courses(session, text, offset, limit)
+    next_cursor = encode_cursor(text, offset + limit) if has_more else None
+    return page_to_dict(rows, next_cursor, get_schema(CourseItemSchema)), 200
+
+
+def update_course(session, course_id, params):
+    course = session.get(Course, course_id)
+    if course is None:
+        return {"message": "Course could not be found."}, 404
+    if not params:
+        return {"message": "No input data provided"}, 400
+    schema = get_schema(CourseSchema)
+    try:
+        data = schema.load(params)
+    except ValidationError as err:
+        return err.messages, 422
+    user = session.get(User, data.courseLector)
+    if user is None:
+        return {"message": "User could not be found."}, 404
+    if user.userType != 'Lector':
+        return {"message": "This user is not lector."}, 406
+    for key, value in params.items():
+        setattr(course, key, value)
+    session.commit()
+    course_index.add(course.id, course.courseName, course.courseDescription)
+    versions.bump_course(course_id)
+    return schema.dump(course), 200
+
+
+def delete_course(session, course_id, later=None):
+    """Delete a course, or hand its id to ``later`` to delete it in the background."""
+    course = session.get(Course, course_id)
+    if course is None:
+        return {"message": "Course could not be found."}, 404
+    if later is not None:
+        course_index.remove(course_id)
+        memberships.clear()
+        versions.bump_course(course_id)
+        later(course_id)
+        return {"message": "Course deletion started."}, 202
+    remove_pending(session, Request.requestToCourse == course.id)
+    # memberships and requests are removed by ON DELETE CASCADE
+    session.delete(course)
+    session.commit()
+    course_index.remove(course_id)
+    memberships.clear()
+    versions.bump_course(course_id)
+    schema = get_schema(CourseSchema)
+    return schema.dump(course), 200
+
+
+def request_page(session, principal, args):
+    try:
+        requests = filter_requests(lector_requests(session, principal.id), args)
+        rows, next_cursor = paginate(requests, args, REQUEST_SORT_KEYS, Request.id)
+    except ValueError as err:
+        return {"message": str(err)}, 400
+    return page_to_dict(rows, next_cursor, get_schema(RequestItemSchema)), 200
+
+
+def add_request(session, principal, params):
+    if not params:
+        return {"message": "No input data provided"}, 400
+    if 'id' in params:
+        return {"message": "You can not change id"}, 400
+    schema = get_schema(RequestSchema)
+    try:
+        data = schema.load(params, partial=("requestToLector",))
+    except ValidationError as err:
+        return err.messages, 422
+    if data.studentId != principal.id:
+        if session.get(User, data.studentId) is None:
+            return {"message": "Student could not be found."}, 404
+        return {"message": "Forbidden"}, 403
+    target = request_targets(session, data.studentId, data.requestToCourse).first()
+    error = request_target_error(target)
+    if error is not None:
+        return error
+    data.requestToLector = target.courseLector
+    session.add(data)
+    try:
+        session.flush()
+    except IntegrityError as err:
+        session.rollback()
+        if not is_duplicate(err, active_request_key):
+            raise
+        return {"message": "Request was already sent."}, 406
+    count_pending(session, [(data.requestToCourse, data.requestToLector)])
+    event = request_event(data)
+    session.commit()
+    bus.publish(*event)
+    versions.bump_users(data.studentId, data.requestToLector)
+    versions.bump_courses(data.requestToCourse)
+    return schema.dump(data), 200
+
+
+def import_error(kind, fmt):
+    if kind not in IMPORTS:
+        return {"message": "Unknown import type"}, 404
+    if fmt not in FORMATS:
+        return {"message": f"format must be one of {', '.join(FORMATS)}"}, 400
+    return None
+
+
+def import_data(session, kind, fmt, stream):
+    inserted, report = import_rows(session, kind, read_rows(stream, fmt))
+    if kind == 'courses':
+        # the rows are bulk inserted without their ids, so the index is loaded again on the next search
+        course_index.clear()
+        versions.bump_catalog()
+    elif kind == 'members':
+        memberships.clear()
+        versions.bump_all()
+    return {"inserted": inserted, "errors": report}, 200
+
+
+def export_error(kind, fmt):
+    if kind not in EXPORTS:
+        return {"message": "Unknown export type"}, 404
+    if fmt not in FORMATTERS:
+        return {"message": f"format must be one of {', '.join(FORMATTERS)}"}, 400
+    return None
+
+
+def add_user(session, params, rehash=hash_password):
+    if not params:
+        return {"message": "No input data provided"}, 400
+    if 'id' in params:
+        return {"message": "You can not change id"}, 400
+    schema = get_schema(UserSchema)
+    try:
+        schema.load(params)
+    except ValidationError as err:
+        return err.messages, 422
+    if session.query(User.id).filter(User.username == params['username']).first() is not None:
+        return {"message": "User with provided username already exists"}, 406
+    user_to_create = User(**params)
+    user_to_create.password = rehash(params['password'])
+    session.add(user_to_create)
+    session.commit()
+    return schema.dump(user_to_create), 200
+
+
+def login(session, params, check=check_password, rehash=hash_password):
+    if not params:
+        return {"message": "No input data provided"}, 400
+    try:
+        params = get_schema(LoginSchema).load(params)
+    except ValidationError as err:
+        return err.messages, 400
+    principal = verify_password(session, params['username'], params['password'], check, rehash)
+    if principal:
+        return {"message": "Logged In", **issue_token(session, principal)}, 200
+    else:
+        return {"message": "Invalid credentials"}, 400
+
+
+def revoke_token(session, principal):
+    user = session.get(User, principal.id)
+    if user is None:
+        return {"message": "User could not be found."}, 404
+    revoke_tokens(user)
+    session.commit()
+    token_versions.invalidate(principal.id)
+    return {"message": "Tokens revoked"}, 200
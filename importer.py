@@ -0,0 +1,158 @@
+import argparse
+import csv
+import io
+import json
+from itertools import islice
+
+from sqlalchemy import tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+from database.tables import *
+from database.counters import count_members
+from schema import *
+from passwords import hash_passwords
+
+CHUNK_SIZE = 1000
+FORMATS = ("csv", "ndjson")
+
+
+def read_rows(stream, fmt):
+    """Yield ``(row number, row)`` pairs from a binary CSV or NDJSON stream one line at a time.
+
+    Lines that are not valid JSON objects are yielded with ``None`` as the row.
+    """
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    if fmt == "csv":
+        for number, row in enumerate(csv.DictReader(text), start=1):
+            yield number, {key: value for key, value in row.items() if value != ""}
+        return
+    for number, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield number, row if isinstance(row, dict) else None
+
+
+def check_users(session, users, errors):
+    usernames = {user.username for _, user in users}
+    existing = {username for username, in session.query(User.username).filter(User.username.in_(usernames))}
+    for number, user in users:
+        if user.username in existing:
+            errors[number] = {"message": "User with provided username already exists"}
+        existing.add(user.username)
+    valid = [user for number, user in users if number not in errors]
+    for user, hashed in zip(valid, hash_passwords([user.password for user in valid])):
+        user.password = hashed
+
+
+def check_courses(session, courses, errors):
+    lector_ids = {course.courseLector for _, course in courses}
+    user_types = dict(session.query(User.id, User.userType).filter(User.id.in_(lector_ids)))
+    for number, course in courses:
+        if course.courseLector not in user_types:
+            errors[number] = {"message": "User could not be found."}
+        elif user_types[course.courseLector] != 'Lector':
+            errors[number] = {"message": "This user is not lector."}
+
+
+def check_course_members(session, members, errors):
+    pairs = {(member.courseId, member.userId) for _, member in members}
+    course_ids = {course_id for course_id, _ in pairs}
+    user_ids = {user_id for _, user_id in pairs}
+    courses = {course_id for course_id, in session.query(Course.id).filter(Course.id.in_(course_ids))}
+    users = {user_id for user_id, in session.query(User.id).filter(User.id.in_(user_ids))}
+    existing = set(session.query(CourseMember.courseId, CourseMember.userId).filter(
+        tuple_(CourseMember.courseId, CourseMember.userId).in_(pairs)))
+    for number, member in members:
+        pair = (member.courseId, member.userId)
+        if member.courseId not in courses:
+            errors[number] = {"message": "Course could not be found."}
+        elif member.userId not in users:
+            errors[number] = {"message": "User could not be found."}
+        elif pair in existing:
+            errors[number] = {"message": "User is already a member of this course."}
+        existing.add(pair)
+    # counted in the chunk's transaction, so the counters are rolled back together with a failed chunk
+    count_members(session, [member.courseId for number, member in members if number not in errors])
+
+
+IMPORTS = {
+    "users": (UserSchema, check_users),
+    "courses": (CourseSchema, check_courses),
+    "members": (CourseMemberSchema, check_course_members),
+}
+
+
+def import_chunk(session, schema, check, chunk):
+    errors = {}
+    rows = []
+    for number, row in chunk:
+        if row is None:
+            errors[number] = {"message": "Invalid row"}
+        elif 'id' in row:
+            errors[number] = {"message": "You can not change id"}
+        else:
+            rows.append((number, row))
+
+    messages = schema.validate([row for _, row in rows])
+    for index, message in messages.items():
+        errors[rows[index][0]] = message
+    rows = [(number, row) for index, (number, row) in enumerate(rows) if index not in messages]
+    objects = list(zip([number for number, _ in rows], schema.load([row for _, row in rows])))
+
+    if objects:
+        check(session, objects, errors)
+    objects = [(number, obj) for number, obj in objects if number not in errors]
+    try:
+        session.bulk_save_objects([obj for _, obj in objects])
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        for number, _ in objects:
+            errors[number] = {"message": "Row conflicts with concurrent changes"}
+        objects = []
+    return len(objects), errors
+
+
+def import_rows(session, kind, rows, chunk_size=CHUNK_SIZE):
+    """Validate and insert ``rows`` chunk by chunk, committing every chunk.
+
+    Returns the number of inserted rows and a list of ``{"row", "errors"}`` reports
+    for the rows that were skipped.
+    """
+    schema_class, check = IMPORTS[kind]
+    schema = get_schema(schema_class, many=True)
+    inserted = 0
+    report = []
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        count, errors = import_chunk(session, schema, check, chunk)
+        inserted += count
+        report.extend({"row": number, "errors": errors[number]} for number in sorted(errors))
+    return inserted, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import users, courses or course members from CSV or NDJSON")
+    parser.add_argument("kind", choices=IMPORTS)
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=FORMATS)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    fmt = args.format or ("csv" if args.path.endswith(".csv") else "ndjson")
+    session = sessionmaker(bind=get_engine())()
+    with open(args.path, "rb") as stream:
+        inserted, report = import_rows(session, args.kind, read_rows(stream, fmt), args.chunk_size)
+    print(json.dumps({"inserted": inserted, "errors": report}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
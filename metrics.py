@@ -0,0 +1,120 @@
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class RequestStats:
+    """Database work done while serving one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.db_time = 0.0
+
+    def server_timing(self):
+        total = time.perf_counter() - self.started
+        return f'db;dur={self.db_time * 1000:.3f};desc="{self.statements} statements", total;dur={total * 1000:.3f}'
+
+
+current_stats = ContextVar("current_stats", default=None)
+
+
+def start_request():
+    stats = RequestStats()
+    current_stats.set(stats)
+    return stats
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    stats = current_stats.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_time += elapsed
+
+
+def instrument(engine):
+    """Count the statements and database time of the current request on ``engine``."""
+    if not event.contains(engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += bucket_count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f"{name}_sum{{{labels}}} {self.sum}"
+        yield f"{name}_count{{{labels}}} {cumulative}"
+
+
+class Metrics:
+    """Per-route request metrics rendered in the Prometheus text format."""
+
+    HISTOGRAMS = (
+        ("http_request_duration_seconds", "Time spent serving requests.", LATENCY_BUCKETS),
+        ("db_duration_seconds", "Time spent in the database per request.", LATENCY_BUCKETS),
+        ("db_statements", "SQL statements executed per request.", STATEMENT_BUCKETS),
+    )
+
+    def __init__(self):
+        self.requests = {}
+        self.histograms = {name: {} for name, _, _ in self.HISTOGRAMS}
+        self._lock = threading.Lock()
+
+    def observe(self, method, route, status, stats):
+        duration = time.perf_counter() - stats.started
+        labels = f'method="{method}",route="{_escape(route)}"'
+        with self._lock:
+            key = f'{labels},status="{status}"'
+            self.requests[key] = self.requests.get(key, 0) + 1
+            for (name, _, buckets), value in zip(self.HISTOGRAMS, (duration, stats.db_time, stats.statements)):
+                histogram = self.histograms[name].get(labels)
+                if histogram is None:
+                    histogram = self.histograms[name][labels] = Histogram(buckets)
+                histogram.observe(value)
+
+    def render(self):
+        with self._lock:
+            lines = ["# HELP http_requests_total Requests served.", "# TYPE http_requests_total counter"]
+            lines.extend(f"http_requests_total{{{key}}} {value}" for key, value in sorted(self.requests.items()))
+            for name, help_text, _ in self.HISTOGRAMS:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in sorted(self.histograms[name].items()):
+                    lines.extend(histogram.samples(name, labels))
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self.requests.clear()
+            for histograms in self.histograms.values():
+                histograms.clear()
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+metrics = Metrics()
@@ -0,0 +1,60 @@
+import asyncio
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+
+import bcrypt
+
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", os.cpu_count() or 4))
+BCRYPT_PREFIXES = ("$2a$", "$2b$", "$2y$")
+
+# bcrypt releases the GIL, so a fixed pool bounds the CPU spent on hashing without serializing it
+executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="bcrypt")
+
+
+def _encode(password):
+    # bcrypt only uses the first 72 bytes; newer releases raise instead of truncating silently
+    return password.encode()[:72]
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(_encode(password), bcrypt.gensalt(rounds)).decode()
+
+
+def _check(password, stored):
+    return bcrypt.checkpw(_encode(password), stored.encode())
+
+
+def is_hashed(stored):
+    return stored.startswith(BCRYPT_PREFIXES)
+
+
+def needs_rehash(stored):
+    """Whether ``stored`` is a legacy plaintext password or a hash with fewer than ``BCRYPT_ROUNDS`` rounds."""
+    return not is_hashed(stored) or int(stored[4:6]) < BCRYPT_ROUNDS
+
+
+def hash_password(password, rounds=BCRYPT_ROUNDS):
+    return executor.submit(_hash, password, rounds).result()
+
+
+def hash_passwords(passwords, rounds=BCRYPT_ROUNDS):
+    return list(executor.map(_hash, passwords, repeat(rounds)))
+
+
+def check_password(password, stored):
+    if not is_hashed(stored):
+        return hmac.compare_digest(password.encode(), stored.encode())
+    return executor.submit(_check, password, stored).result()
+
+
+async def hash_password_async(password, rounds=BCRYPT_ROUNDS):
+    return await asyncio.wrap_future(executor.submit(_hash, password, rounds))
+
+
+async def check_password_async(password, stored):
+    if not is_hashed(stored):
+        return hmac.compare_digest(password.encode(), stored.encode())
+    return await asyncio.wrap_future(executor.submit(_check, password, stored))
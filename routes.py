@@ -1,40 +1,101 @@
+import time
 from functools import wraps
 
-from flask_bcrypt import Bcrypt
-from flask_httpauth import HTTPBasicAuth
-from marshmallow import ValidationError
-from sqlalchemy.orm import sessionmaker
-from flask import jsonify, request, Blueprint
-from database.tables import *
-from schema import *
+from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth, MultiAuth
+from sqlalchemy.orm import scoped_session, sessionmaker
+from flask import g, jsonify, make_response, request, Blueprint, Response, stream_with_context
+from database.tables import engine_hooks, get_replica_engines
+from database.cascade import delete_course_in_chunks, executor, logger
+from database.routing import ReplicaPool, RoutingSession
+from database.listing import available_courses, lector_courses, student_courses
+from cache import response_etag
+from exporter import MIMETYPES, stream_batches, write_batches
+from metrics import current_stats, instrument, metrics, start_request
+from admission import admission, route_class
+from events import EVENT_HEARTBEAT, EVENT_MAX_STREAMS, EVENT_RETRY_MS, EVENT_STREAM_TIMEOUT, bus, \
+    last_event_id, stream_chunks
+from handlers import admission_key, admission_refusal, catalog_version, course_version, memberships, \
+    reads_from_replica, responses, versions
+import handlers
+
+replicas = ReplicaPool(get_replica_engines)
+session = sessionmaker(class_=RoutingSession, replicas=replicas)
+s = scoped_session(session)
 
-session = sessionmaker(bind=engine)
-s = session()
+query = Blueprint("query", __name__)
+basic_auth = HTTPBasicAuth()
+token_auth = HTTPTokenAuth(scheme="Bearer")
+auth = MultiAuth(basic_auth, token_auth)
 
-bcrypt = Bcrypt()
 
-query = Blueprint("query", __name__)
-auth = HTTPBasicAuth()
+engine_hooks.append(instrument)
+
+
+@query.before_app_request
+def start_timing():
+    start_request()
+
+
+@query.before_app_request
+def route_reads():
+    s.info["replica"] = reads_from_replica(request.method, request.headers)
+
+
+@query.after_app_request
+def add_server_timing(response):
+    stats = current_stats.get()
+    if stats is not None:
+        response.headers["Server-Timing"] = stats.server_timing()
+        metrics.observe(request.method, request.url_rule.rule if request.url_rule else "unmatched",
+                        response.status_code, stats)
+    return response
 
 
-@auth.verify_password
+@query.teardown_app_request
+def remove_session(exception=None):
+    s.remove()
+
+
+@query.before_request
+def admit_request():
+    if request.method == "OPTIONS":
+        return None
+    refused = admission.admit(admission_key(request.headers.get("Authorization", ""), request.remote_addr),
+                              route_class(request.method))
+    if refused is not None:
+        return admission_refusal(*refused)
+    g.admitted = True
+
+
+@query.teardown_request
+def release_admission(exception=None):
+    if g.pop("admitted", False):
+        admission.release()
+
+
+@basic_auth.verify_password
 def verify_password(username, password):
-    user = s.query(User).filter(User.username == username).one_or_none()
-    if user is None:
-        return False
+    return handlers.verify_password(s(), username, password)
+
+
+@token_auth.verify_token
+def verify_token(token):
+    return handlers.verify_token(s(), token)
 
-    if user.password != password:
-        return False
 
-    return user
+def reply(result):
+    # Flask only serializes dict bodies itself
+    body, *rest = result
+    return (jsonify(body) if isinstance(body, list) else body, *rest)
 
 
 def permission_required(permission):
     def decorator(func):
         @wraps(func)
         def decorated_function(*args, **kwargs):
-            if auth.current_user().userType != permission:
-                return {"message": "Forbidden"}, 403
+            error = handlers.permission_error(auth.current_user(), permission)
+            if error is not None:
+                return error
             return func(*args, **kwargs)
 
         return decorated_function
@@ -42,314 +103,246 @@ def permission_required(permission):
     return decorator
 
 
+def cached_response(version_of):
+    def decorator(func):
+        @wraps(func)
+        def decorated_function(*args, **kwargs):
+            user_id = auth.current_user().id
+            etag = response_etag(versions.epoch, request.endpoint, request.query_string, user_id,
+                                 version_of(user_id, **kwargs))
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                cached = responses.get(etag)
+                if cached is None:
+                    response = make_response(func(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    if s().may_be_stale():
+                        # the replica may not have the writes the versions in the ETag stand for yet
+                        return response
+                    cached = (response.get_data(), response.mimetype)
+                    responses.set(etag, cached)
+                response = Response(cached[0], mimetype=cached[1])
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "private, no-cache"
+            return response
+
+        return decorated_function
+
+    return decorator
+
+
 @query.route('/user/<string:username>', methods=['GET'])
 @auth.login_required
 def get_user(username):
-    if auth.username() != s.query(User).filter_by(username=username).first().username:
-        return {"message": "Forbidden"}, 403
-    user = s.query(User).filter(User.username == username).first()
-    if user is None:
-        return {"message": "User could not be found."}, 404
-    schema = UserSchema()
-    return schema.dump(user), 200
+    return handlers.get_user(s(), auth.current_user(), username)
 
 
 @query.route('/user/<string:username>', methods=['PUT'])
 @auth.login_required
 def update_user(username):
-    if auth.username() != s.query(User).filter_by(username=username).first().username:
-        return {"message": "Forbidden"}, 403
-    params = request.json
-    if not params:
-        return {"message": "No input data provided"}, 400
-    if 'id' in params:
-        return {"message": "You can not change id"}, 400
-    user = s.query(User).filter(User.username == username).first()
-    if user is None:
-        return {"message": "User could not be found."}, 404
-    check_username = s.query(User).filter(User.username == request.json.get('username')).first()
-    if check_username is not None and request.json.get('username') != username:
-        return {"message": "User with provided username already exists"}, 406
-    for key, value in params.items():
-        setattr(user, key, value)
-    s.commit()
-    return params, 200
+    return handlers.update_user(s(), auth.current_user(), username, request.json)
 
 
 @query.route('/user/<string:username>', methods=['DELETE'])
 @auth.login_required()
 def delete_user(username):
-    if auth.username() != s.query(User).filter_by(username=username).first().username:
-        return {"message": "Forbidden"}, 403
-    user = s.query(User).filter(User.username == username).first()
-    if user is None:
-        return {"message": "User could not be found."}, 404
-    s.query(CourseMember).filter(CourseMember.userId == user.id).delete(synchronize_session="fetch")
-    s.query(Request).filter(Request.requestToLector == user.id).delete(synchronize_session="fetch")
-    s.query(Request).filter(Request.studentId == user.id).delete(synchronize_session="fetch")
-    s.delete(user)
-    s.commit()
-    schema = UserSchema()
-    return schema.dump(user), 200
+    return handlers.delete_user(s(), auth.current_user(), username)
 
 
 @query.route('/user/acceptrequest/<int:request_id>', methods=['PUT'])
 @auth.login_required()
 @permission_required('Lector')
 def accept_request(request_id):
-    req = s.query(Request).filter(Request.id == request_id).first()
-    if req is None:
-        return {"message": "Request could not be found."}, 404
-    setattr(req, 'status', 'Accepted')
-    s.query(Request).filter(Request.id == request_id).delete(synchronize_session="fetch")
-    new_course_member = CourseMember(courseId=getattr(req, 'requestToCourse'), userId=getattr(req, 'studentId'))
-    s.add(new_course_member)
-    s.commit()
-    return {"message": "Accepted"}, 200
+    return handlers.accept_request(s(), request_id)
 
 
 @query.route('/user/declinerequest/<int:request_id>', methods=['PUT'])
 @auth.login_required()
 @permission_required('Lector')
 def decline_request(request_id):
-    req = s.query(Request).filter(Request.id == request_id).first()
-    if req is None:
-        return {"message": "Request could not be found."}, 404
-    setattr(req, 'status', 'Declined')
-    s.commit()
-    return {"message": "Declined"}, 200
+    return handlers.decline_request(s(), request_id)
+
+
+@query.route('/user/requests', methods=['PUT'])
+@auth.login_required()
+@permission_required('Lector')
+def handle_requests():
+    return reply(handlers.handle_requests(s(), auth.current_user(), request.json))
 
 
 @query.route('/course', methods=['POST'])
 @auth.login_required()
 @permission_required('Lector')
 def add_course():
-    new_course_json = request.json
-    if not new_course_json:
-        return {"message": "No input data provided"}, 400
-    if 'id' in new_course_json:
-        return {"message": "You can not change id"}, 400
-    schema = CourseSchema()
-    try:
-        data = schema.load(new_course_json)
-    except ValidationError as err:
-        return err.messages, 422
-    user_lector = s.query(User).filter(User.id == request.json.get('courseLector')).first()
-    if user_lector is None:
-        return {"message": "User could not be found."}, 404
-    if user_lector.userType != 'Lector':
-        return {"message": "This user is not lector."}, 406
-    s.add(data)
-    s.commit()
-    return schema.dump(data), 200
+    return handlers.add_course(s(), request.json)
 
 
 @query.route('/course/<int:course_id>', methods=['GET'])
 @auth.login_required()
+@cached_response(course_version)
 def get_course(course_id):
-    courses = s.query(Course).join(CourseMember).filter(CourseMember.userId == auth.current_user().id).all()
-    course = s.query(Course).filter(Course.id == course_id).first()
-    if course is None:
-        return {"message": "Course could not be found."}, 404
-    is_user_course = False
-    for course_iter in courses:
-        if course_id == course_iter.id:
-            is_user_course = True
-    if not is_user_course:
-        return {"message": "Forbidden"}, 403
-    schema = CourseSchema()
-    return schema.dump(course), 200
+    return handlers.get_course(s(), auth.current_user(), course_id)
 
 
 @query.route('/lector/courses', methods=['GET'])
 @auth.login_required()
 @permission_required('Lector')
+@cached_response(catalog_version)
 def get_all_courses_lector():
-    courses = s.query(Course).filter(Course.courseLector == auth.current_user().id).all()
-    coursesData = []
-    for course in courses:
-        lector_username = s.query(User).filter_by(id=course.courseLector).first().username
-        coursesData.append(
-            {"id": course.id, "courseName": course.courseName, "courseDescription": course.courseDescription,
-             "lectorUsername": lector_username})
-    return jsonify(coursesData), 200
+    return handlers.course_page(s(), lector_courses, auth.current_user(), request.args)
+
+
+@query.route('/user/course', methods=['GET'])
+@auth.login_required()
+@permission_required('Lector')
+def get_user_courses():
+    return reply(handlers.user_courses(s(), auth.current_user()))
 
 
 @query.route('/student/courses', methods=['GET'])
 @auth.login_required()
+@cached_response(catalog_version)
 def get_all_courses_student():
-    courses_results = s.query(Course.id, Course.courseDescription, Course.courseDescription, Course.courseLector,
-                              CourseMember.userId).join(
-        CourseMember).all()
-    courses = []
-    for result in courses_results:
-        if result[4] == auth.current_user().id:
-            lector_username = s.query(User).filter_by(id=result[3]).first().username
-            courses.append({"id": result[0], "courseName": result[1], "courseDescription": result[2],
-                            "lectorUsername": lector_username})
-    return jsonify(courses), 200
+    return handlers.course_page(s(), student_courses, auth.current_user(), request.args)
 
 
 @query.route('/courses', methods=['GET'])
 @auth.login_required()
+@cached_response(catalog_version)
 def get_all_courses():
-    all_courses_results = s.query(Course.id, Course.courseDescription, Course.courseDescription,
-                                  Course.courseLector).all()
-    member_courses_results = s.query(Course.id, Course.courseDescription, Course.courseDescription, Course.courseLector,
-                                     CourseMember.userId).join(
-        CourseMember).all()
-
-    member_courses_ids = []
-    for result in member_courses_results:
-        member_courses_ids.append(result[0])
-
-    requests_results = s.query(Request).filter(Request.studentId == auth.current_user().id).all()
-    declined_courses_ids = []
-    for result in requests_results:
-        if result.status == 'Declined':
-            declined_courses_ids.append(result.requestToCourse)
-
-    courses = []
-    for result in all_courses_results:
-        if result[0] not in member_courses_ids:
-            lector_username = s.query(User).filter_by(id=result[3]).first().username
-            course = {"id": result[0], "courseName": result[1], "courseDescription": result[2],
-                      "lectorUsername": lector_username, "requestStatus": ""}
-            if result[0] in declined_courses_ids:
-                course["requestStatus"] = "Declined"
-            courses.append(course)
-    return jsonify(courses), 200
+    return handlers.course_page(s(), available_courses, auth.current_user(), request.args)
+
+
+@query.route('/courses/search', methods=['GET'])
+@auth.login_required()
+@cached_response(catalog_version)
+def search_course():
+    return handlers.search_course(s(), request.args)
 
 
 @query.route('/course/<int:course_id>', methods=['PUT'])
 @auth.login_required()
 @permission_required('Lector')
 def update_course(course_id):
-    course = s.query(Course).filter(Course.id == course_id).first()
-    if course is None:
-        return {"message": "Course could not be found."}, 404
-    params = request.json
-    if not params:
-        return {"message": "No input data provided"}, 400
-    schema = CourseSchema()
-    try:
-        data = schema.load(params)
-    except ValidationError as err:
-        return err.messages, 422
-    user = s.query(User).filter(User.id == request.json.get('courseLector')).first()
-    if user is None:
-        return {"message": "User could not be found."}, 404
-    if user.userType != 'Lector':
-        return {"message": "This user is not lector."}, 406
-    for key, value in params.items():
-        setattr(course, key, value)
-    s.commit()
-    return schema.dump(data), 200
+    return handlers.update_course(s(), course_id, request.json)
 
 
 @query.route('/course/<int:course_id>', methods=['DELETE'])
 @auth.login_required()
 @permission_required('Lector')
 def delete_course(course_id):
-    course = s.query(Course).filter(Course.id == course_id).first()
-    if course is None:
-        return {"message": "Course could not be found."}, 404
-    s.query(CourseMember).filter(CourseMember.courseId == course.id).delete(synchronize_session="fetch")
-    s.query(Request).filter(Request.requestToCourse == course.id).delete(synchronize_session="fetch")
-    s.delete(course)
-    s.commit()
-    schema = CourseSchema()
-    return schema.dump(course), 200
+    later = None
+    if request.args.get("background", "false").lower() == "true":
+        later = start_delete_course
+    return handlers.delete_course(s(), course_id, later)
+
+
+def start_delete_course(course_id):
+    executor.submit(delete_course_later, course_id)
+
+
+def delete_course_later(course_id):
+    try:
+        delete_course_in_chunks(s(), course_id)
+        memberships.clear()
+        versions.bump_course(course_id)
+    except Exception:
+        logger.exception("Deleting course %s in the background failed", course_id)
+    finally:
+        s.remove()
 
 
 @query.route('/lector/requests', methods=['GET'])
 @auth.login_required()
 @permission_required('Lector')
+@cached_response(catalog_version)
 def get_all_requests():
-    requests_result = s.query(Request).filter(Request.requestToLector == auth.current_user().id).filter(Request.status=="OnHold").all()
-    requests = []
-    for result in requests_result:
-        course = s.query(Course).filter(Course.id == result.requestToCourse).first()
-        course_name = course.courseName
-        user = s.query(User).filter(User.id == result.studentId).first()
-        student_username = user.username
-        requests.append({"id": result.id, "courseName": course_name, "studentName": student_username})
-    return jsonify(requests), 200
+    return handlers.request_page(s(), auth.current_user(), request.args)
 
 
 @query.route('/request', methods=['POST'])
 @auth.login_required()
 @permission_required('Student')
 def add_request():
-    new_request = request.json
-    if not new_request:
-        return {"message": "No input data provided"}, 400
-    if 'id' in new_request:
-        return {"message": "You can not change id"}, 400
-    course = s.query(Course).filter(Course.id == request.json.get('requestToCourse')).first()
-    lector_id = s.query(User).filter(User.id == course.courseLector).first().id
-    new_request['requestToLector'] = lector_id
-    schema = RequestSchema()
-    try:
-        data = schema.load(new_request)
-    except ValidationError as err:
-        return err.messages, 422
-    if new_request['studentId'] != auth.current_user().id:
-        return {"message": "Forbidden"}, 403
-    course = s.query(Course).filter(Course.id == request.json.get('requestToCourse')).first()
-    user_lector = s.query(User).filter(User.id == course.courseLector).first()
-    if user_lector is None:
-        return {"message": "Lector could not be found."}, 404
-    if user_lector.userType != 'Lector':
-        return {"message": "This user is not a lector."}, 406
-    user_student = s.query(User).filter(User.id == request.json.get('studentId')).first()
-    if user_student is None:
-        return {"message": "Student could not be found."}, 404
-    if user_student.userType != 'Student':
-        return {"message": "This user is not a student."}, 406
-    course = s.query(Course).filter(Course.id == request.json.get('requestToCourse')).first()
-    request_to_join = s.query(Request).filter(Request.studentId == request.json.get('studentId')).filter(
-        Request.requestToCourse == request.json.get('requestToCourse')).filter(
-        Request.status != "Declined").all()
-    if len(request_to_join) >= 1:
-        return {"message": "Request was already sent."}, 406
-    if course is None:
-        return {"message": "Course could not be found."}, 404
-    if course.courseLector != user_lector.id:
-        return {"message": "Provided lector is not allowed to accept this request."}, 406
-    if course.courseLector != user_lector.id:
-        return {"message": "Provided lector is not allowed to accept this request."}, 406
-    s.add(data)
-    s.commit()
-    return schema.dump(data), 200
+    return handlers.add_request(s(), auth.current_user(), request.json)
+
+
+@query.route('/import/<string:kind>', methods=['POST'])
+@auth.login_required()
+@permission_required('Lector')
+def import_data(kind):
+    fmt = request.args.get('format', 'csv' if request.mimetype == 'text/csv' else 'ndjson')
+    error = handlers.import_error(kind, fmt)
+    if error is not None:
+        return error
+    stream = request.files['file'].stream if 'file' in request.files else request.stream
+    return handlers.import_data(s(), kind, fmt, stream)
+
+
+@query.route('/export/<string:kind>', methods=['GET'])
+@auth.login_required()
+@permission_required('Lector')
+def export_data(kind):
+    fmt = request.args.get('format', 'ndjson')
+    error = handlers.export_error(kind, fmt)
+    if error is not None:
+        return error
+    batches = stream_batches(s, kind, auth.current_user().id)
+    return Response(stream_with_context(write_batches(batches, fmt)), mimetype=MIMETYPES[fmt])
+
+
+@query.route('/events', methods=['GET'])
+@auth.login_required()
+def get_events():
+    last_id = last_event_id(request.headers.get("Last-Event-ID", request.args.get("lastEventId")), bus.last_id)
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    if not bus.open_stream(EVENT_MAX_STREAMS):
+        # every stream thread is taken: answer at once with the missed events, the client polls again after retry
+        events, position = bus.since(auth.current_user().id, last_id)
+        return Response(f"retry: {EVENT_RETRY_MS}\n\n" + "".join(stream_chunks(events, last_id, position)),
+                        mimetype="text/event-stream", headers=headers)
+    response = Response(event_stream(auth.current_user().id, last_id), mimetype="text/event-stream", headers=headers)
+    response.call_on_close(bus.close_stream)
+    return response
+
+
+def event_stream(user_id, last_id):
+    # every open stream holds a server thread, so it ends after a while and the client reconnects
+    yield f"retry: {EVENT_RETRY_MS}\n\n"
+    deadline = time.monotonic() + EVENT_STREAM_TIMEOUT
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        events, position = bus.wait(user_id, last_id, min(EVENT_HEARTBEAT, remaining))
+        yield "".join(stream_chunks(events, last_id, position))
+        last_id = position
+
+
+@query.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(handlers.metrics_text(), mimetype="text/plain; version=0.0.4")
 
 
 @query.route('/auth/register', methods=['POST'])
 def add_user():
-    new_user_json = request.json
-    if not new_user_json:
-        return {"message": "No input data provided"}, 400
-    if 'id' in new_user_json:
-        return {"message": "You can not change id"}, 400
-    schema = UserSchema()
-    try:
-        schema.load(new_user_json)
-    except ValidationError as err:
-        return err.messages, 422
-    if s.query(User).filter(User.username == request.json.get('username')).first() is not None:
-        return {"message": "User with provided username already exists"}, 406
-    user_to_create = User(**new_user_json)
-    user_to_create.password = new_user_json['password']
-    s.add(user_to_create)
-    s.commit()
-    return schema.dump(user_to_create), 200
+    return handlers.add_user(s(), request.json)
 
 
 @query.route('/auth/login', methods=['POST'])
 def login_post():
-    user_data = request.json
+    return handlers.login(s(), request.json)
 
-    if verify_password(user_data['username'], user_data['password']):
-        return {"message": "Logged In"}, 200
-    else:
-        return {"message": "Invalid credentials"}, 400
+
+@query.route('/auth/refresh', methods=['POST'])
+@auth.login_required()
+def refresh_token():
+    return handlers.issue_token(s(), auth.current_user()), 200
+
+
+@query.route('/auth/revoke', methods=['POST'])
+@auth.login_required()
+def revoke_token():
+    return handlers.revoke_token(s(), auth.current_user())
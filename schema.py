@@ -1,33 +1,115 @@
-from marshmallow import Schema, fields, validate, post_load
+from operator import attrgetter
+
+from marshmallow import Schema, fields, validate, post_dump, post_load
+from marshmallow.decorators import PRE_DUMP, POST_DUMP
 
 from database.tables import Course, Request, CourseMember, User
 
+SIMPLE_FIELDS = (fields.Integer, fields.String)
+
+
+class CompiledSchema(Schema):
+    """Schema whose ``dump`` uses a function generated once per source type instead of walking the fields.
+
+    Integer and string fields are copied as they are, other fields go through their ``_serialize``, and
+    fields whose attribute is missing from a ``Row`` are left out, as marshmallow does. All items of a
+    ``many`` dump are expected to have the shape of the first one.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._dumpers = {}
+
+    def dump(self, obj, *, many=None):
+        many = self.many if many is None else many
+        obj = self._invoke_dump_processors(PRE_DUMP, obj, many=many, original_data=obj)
+        items = list(obj) if many else [obj]
+        if not items:
+            return []
+        dumper = self._dumper(items[0])
+        result = [dumper(item) for item in items] if many else dumper(items[0])
+        return self._invoke_dump_processors(POST_DUMP, result, many=many, original_data=obj)
+
+    def _dumper(self, obj):
+        key = obj._fields if hasattr(obj, "_fields") else type(obj)
+        dumper = self._dumpers.get(key)
+        if dumper is None:
+            dumper = self._dumpers[key] = self._compile(obj._fields if hasattr(obj, "_fields") else None)
+        return dumper
+
+    def _compile(self, source_fields):
+        simple = []
+        other = []
+        for name, field in self.dump_fields.items():
+            attribute = field.attribute or name
+            if source_fields is not None and attribute not in source_fields:
+                continue
+            if type(field) in SIMPLE_FIELDS:
+                simple.append((field.data_key or name, attribute))
+            else:
+                other.append((field.data_key or name, attribute, field))
+        keys = tuple(key for key, _ in simple)
+        getter = attrgetter(*(attribute for _, attribute in simple)) if len(simple) > 1 else None
+
+        def dump(obj):
+            if getter is not None:
+                data = dict(zip(keys, getter(obj)))
+            else:
+                data = {key: getattr(obj, attribute) for key, attribute in simple}
+            for key, attribute, field in other:
+                data[key] = field._serialize(getattr(obj, attribute), attribute, obj)
+            return data
+
+        return dump
+
+
+_schemas = {}
+
+
+def get_schema(schema_class, many=False):
+    """Return the shared instance of ``schema_class``; schemas keep no state between calls."""
+    schema = _schemas.get((schema_class, many))
+    if schema is None:
+        schema = _schemas[(schema_class, many)] = schema_class(many=many)
+    return schema
 
-class UserSchema(Schema):
+
+class UserSchema(CompiledSchema):
     id = fields.Integer()
     username = fields.Str(validate=validate.Length(max=45), required=True)
     firstName = fields.Str(validate=validate.Length(max=45), required=True)
     lastName = fields.Str(validate=validate.Length(max=45), required=True)
+    email = fields.Email(validate=validate.Length(max=45))
     password = fields.Str(validate=validate.Length(max=100), required=True, load_only=True)
+    phone = fields.Str(validate=validate.Length(max=45))
     userType = fields.Str(validate=validate.OneOf(["Student", "Lector"]), required=True)
+    pendingRequestCount = fields.Integer(dump_only=True)
 
     @post_load
     def make_user(self, data, **kwargs):
         return User(**data)
 
+    @post_dump
+    def drop_lector_fields(self, data, **kwargs):
+        if data.get("userType") != "Lector":
+            data.pop("pendingRequestCount", None)
+        return data
+
 
-class CourseSchema(Schema):
+class CourseSchema(CompiledSchema):
     id = fields.Integer()
     courseName = fields.Str(validate=validate.Length(max=45), required=True)
     courseDescription = fields.Str(validate=validate.Length(max=500), required=True)
     courseLector = fields.Integer(required=True)
+    memberCount = fields.Integer(dump_only=True)
+    pendingRequestCount = fields.Integer(dump_only=True)
 
     @post_load
     def make_course(self, data, **kwargs):
         return Course(**data)
 
 
-class RequestSchema(Schema):
+class RequestSchema(CompiledSchema):
     id = fields.Integer()
     studentId = fields.Integer(required=True)
     requestToCourse = fields.Integer(required=True)
@@ -39,7 +121,7 @@ class RequestSchema(Schema):
         return Request(**data)
 
 
-class CourseMemberSchema(Schema):
+class CourseMemberSchema(CompiledSchema):
     id = fields.Integer()
     courseId = fields.Integer(required=True)
     userId = fields.Integer(required=True)
@@ -47,3 +129,34 @@ class CourseMemberSchema(Schema):
     @post_load
     def make_course_member(self, data, **kwargs):
         return CourseMember(**data)
+
+
+class RequestActionSchema(CompiledSchema):
+    ids = fields.List(fields.Integer(), validate=validate.Length(min=1, max=10000), required=True)
+    action = fields.Str(validate=validate.OneOf(["accept", "decline"]), required=True)
+
+
+class LoginSchema(CompiledSchema):
+    username = fields.Str(required=True)
+    password = fields.Str(required=True)
+
+
+class RequestStatus(fields.Field):
+    def _serialize(self, value, attr, obj, **kwargs):
+        return "Declined" if value else ""
+
+
+class CourseItemSchema(CompiledSchema):
+    id = fields.Integer()
+    courseName = fields.Str()
+    courseDescription = fields.Str()
+    lectorUsername = fields.Str()
+    requestStatus = RequestStatus(attribute="declined")
+    memberCount = fields.Integer()
+    pendingRequestCount = fields.Integer()
+
+
+class RequestItemSchema(CompiledSchema):
+    id = fields.Integer()
+    courseName = fields.Str()
+    studentName = fields.Str()
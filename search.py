@@ -0,0 +1,112 @@
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+
+from sqlalchemy.dialects.mysql import match
+
+from database.tables import Course
+from database.listing import course_rows
+
+TOKEN = re.compile(r"\w\w+", re.UNICODE)
+NAME_WEIGHT = 3
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+
+class CourseIndex:
+    """In-process inverted index over course names and descriptions, ranked with BM25.
+
+    Used when the database has no full-text search. It is filled from the database on the
+    first search and kept up to date by ``add``/``remove`` from the course write handlers.
+    """
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.terms = {}
+        self.lengths = {}
+        self.total_length = 0
+        self.loaded = False
+        self._lock = threading.RLock()
+
+    def add(self, course_id, name, description):
+        terms = Counter(tokenize(name) * NAME_WEIGHT + tokenize(description))
+        with self._lock:
+            self._remove(course_id)
+            for term, frequency in terms.items():
+                self.postings[term][course_id] = frequency
+            self.terms[course_id] = list(terms)
+            self.lengths[course_id] = sum(terms.values())
+            self.total_length += self.lengths[course_id]
+
+    def remove(self, course_id):
+        with self._lock:
+            self._remove(course_id)
+
+    def _remove(self, course_id):
+        length = self.lengths.pop(course_id, None)
+        if length is None:
+            return
+        self.total_length -= length
+        for term in self.terms.pop(course_id):
+            postings = self.postings[term]
+            del postings[course_id]
+            if not postings:
+                del self.postings[term]
+
+    def load(self, session):
+        with self._lock:
+            if self.loaded:
+                return
+            for course in session.query(Course.id, Course.courseName, Course.courseDescription).yield_per(1000):
+                self.add(course.id, course.courseName, course.courseDescription)
+            self.loaded = True
+
+    def search(self, query):
+        """Return ``(course id, score)`` pairs matching any term of ``query``, best first."""
+        with self._lock:
+            count = len(self.lengths)
+            if not count:
+                return []
+            average = self.total_length / count
+            scores = defaultdict(float)
+            for term in set(tokenize(query)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for course_id, frequency in postings.items():
+                    norm = K1 * (1 - B + B * self.lengths[course_id] / average)
+                    scores[course_id] += idf * frequency * (K1 + 1) / (frequency + norm)
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+    def clear(self):
+        with self._lock:
+            self.postings.clear()
+            self.terms.clear()
+            self.lengths.clear()
+            self.total_length = 0
+            self.loaded = False
+
+
+course_index = CourseIndex()
+
+
+def search_courses(session, query, offset, limit):
+    """Return the ``limit`` best matching course rows after ``offset`` and whether more rows follow."""
+    if session.get_bind().dialect.name == "mysql":
+        score = match(Course.courseName, Course.courseDescription, against=query)
+        rows = course_rows(session).add_columns(score.label("score")).filter(score > 0).order_by(
+            score.desc(), Course.id).offset(offset).limit(limit + 1).all()
+        return rows[:limit], len(rows) > limit
+
+    course_index.load(session)
+    ranked = course_index.search(query)
+    page = ranked[offset:offset + limit]
+    courses = {row.id: row for row in course_rows(session).filter(Course.id.in_([course_id for course_id, _ in page]))}
+    rows = [courses[course_id] for course_id, _ in page if course_id in courses]
+    return rows, len(ranked) > offset + limit
@@ -1,17 +1,134 @@
+import asyncio
+import atexit
+import bcrypt
 import base64
+import json
+import os
+import shutil
+import tempfile
 import unittest
 import requests
+from urllib.parse import urlsplit
+
+# cheap hashes keep the suite fast; rounds 4 hashes are still below the cost and get rehashed
+os.environ.setdefault("BCRYPT_ROUNDS", "5")
+# event streams end quickly, so a test can read a whole one
+os.environ.setdefault("EVENT_STREAM_TIMEOUT", "0.2")
+
+from sqlalchemy.exc import IntegrityError
 
 from routes import *
-from app import app
+from handlers import PRIMARY_HEADER, active_request_key, admission, admission_key, course_index, is_duplicate, \
+    memberships, metrics, principals, request_row, responses, settle_pending, token_versions, versions
+from app import create_app
+from database.tables import *
+from schema import *
+from asgi import create_app as create_async_app, background_tasks, dispose_async_engines
+from database.querylog import QueryStats, fingerprint
+from cache import TTLCache
+from database.counters import rebuild
+from database.listing import encode_cursor
+from database.cascade import delete_course_in_chunks, executor
+from passwords import check_password, needs_rehash
+from admission import Admission
+from events import EVENT_MAX_STREAMS, bus
 
 url = "http://127.0.0.1:5000/"
 
+# a throwaway SQLite file by default, which the sync and the async app both open
+_directory = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, _directory, True)
+database = os.environ.get("TEST_DATABASE_URL", f"sqlite:///{_directory}/tests.db")
+app = create_app({"DATABASE_URL": database})
+async_app = create_async_app({"DATABASE_URL": database})
+Base.metadata.create_all(get_engine())
 
-class TestUserInteraction(unittest.TestCase):
-    def setUp(self) -> None:
+
+def clear_caches():
+    principals.clear()
+    token_versions.clear()
+    responses.clear()
+    versions.bump_all()
+    course_index.clear()
+    metrics.clear()
+    memberships.clear()
+    admission.clear()
+    bus.clear()
+
+
+class AsyncResponse:
+    def __init__(self, response, data):
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.mimetype = response.mimetype
+        self.data = data
+
+    @property
+    def json(self):
+        return json.loads(self.data) if self.mimetype == "application/json" else None
+
+    def get_data(self, as_text=False):
+        return self.data.decode() if as_text else self.data
+
+    def close(self):
+        pass
+
+
+class AsyncTestClient:
+    """Sends requests to the async app through the calls of Flask's test client, on an event loop of its own."""
+
+    def __init__(self, app):
+        self.loop = asyncio.new_event_loop()
         self.client = app.test_client()
 
+    def open(self, path, method="GET", **kwargs):
+        async def send():
+            response = await self.client.open(urlsplit(path).path, method=method, **kwargs)
+            return AsyncResponse(response, await response.get_data())
+
+        return self.loop.run_until_complete(send())
+
+    def get(self, path, **kwargs):
+        return self.open(path, "GET", **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open(path, "POST", **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.open(path, "PUT", **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.open(path, "DELETE", **kwargs)
+
+    def close(self):
+        self.loop.run_until_complete(dispose_async_engines())
+        self.loop.close()
+
+
+class AppTestCase(unittest.TestCase):
+    def make_client(self):
+        return app.test_client()
+
+    def wait_for_background(self):
+        executor.submit(int).result()
+
+
+class AsyncAppTestCase:
+    """Runs the scenarios of the ``AppTestCase`` it is mixed into against the async app."""
+
+    def make_client(self):
+        client = AsyncTestClient(async_app)
+        self.addCleanup(client.close)
+        return client
+
+    def wait_for_background(self):
+        self.client.loop.run_until_complete(asyncio.gather(*background_tasks))
+
+
+class TestUserInteraction(AppTestCase):
+    def setUp(self) -> None:
+        self.client = self.make_client()
+
         self.student_username = "student1"
         self.student_password = "12345"
         self.lector_username = "lector1"
@@ -34,6 +151,7 @@ class TestUserInteraction(unittest.TestCase):
         s.commit()
         s.execute("DELETE FROM user")
         s.commit()
+        clear_caches()
 
     def testAddUser(self):
         addUserUrl = url + 'auth/register'
@@ -156,9 +274,9 @@ class TestUserInteraction(unittest.TestCase):
         self.assertEqual(200, self.client.post(addRequestUrl, headers=self.auth_student_headers, json=test_request).status_code)
 
 
-class TestCourseInteraction(unittest.TestCase):
+class TestCourseInteraction(AppTestCase):
     def setUp(self) -> None:
-        self.client = app.test_client()
+        self.client = self.make_client()
 
         self.course_name = "course1"
 
@@ -173,6 +291,7 @@ class TestCourseInteraction(unittest.TestCase):
         s.commit()
         s.execute("DELETE FROM user")
         s.commit()
+        clear_caches()
 
     def testAddCourse(self):
         addCourseUrl = '/course'
@@ -270,3 +389,604 @@ class TestCourseInteraction(unittest.TestCase):
         self.client.post('/course', headers=self.auth_lector_headers, json=test_course_correct)
         self.assertEqual(200, self.client.get(courseUrl, headers=self.auth_lector_headers).status_code)
         self.assertEqual(403, self.client.get(courseUrl, headers=self.auth_student_headers).status_code)
+
+
+class TestCourseListing(AppTestCase):
+    def setUp(self) -> None:
+        self.client = self.make_client()
+
+        self.test_student = {"username": "student1", "firstName": "firstName", "lastName": "lastName", "password": "12345", "userType": "Student"}
+        self.test_lector = {"username": "lector1", "firstName": "firstName", "lastName": "lastName", "password": "12345", "userType": "Lector"}
+
+        self.auth_student_headers = {'Authorization': f'Basic ' + base64.b64encode(b"student1:12345").decode("UTF-8")}
+        self.auth_lector_headers = {'Authorization': f'Basic ' + base64.b64encode(b"lector1:12345").decode("UTF-8")}
+
+        self.student_id = int(self.client.post('/auth/register', json=self.test_student).json.get('id'))
+        self.lector_id = int(self.client.post('/auth/register', json=self.test_lector).json.get('id'))
+        self.course_ids = [int(self.client.post('/course', headers=self.auth_lector_headers, json={"courseName": f"course{i}", "courseDescription": "description", "courseLector": self.lector_id}).json.get('id')) for i in range(7)]
+
+    def tearDown(self) -> None:
+        s.execute("DELETE FROM request")
+        s.execute("DELETE FROM courseMember")
+        s.execute("DELETE FROM course")
+        s.execute("DELETE FROM user")
+        s.commit()
+        clear_caches()
+
+    def testCoursesPagination(self):
+        course_ids = []
+        cursor = None
+        while True:
+            params = {"limit": 3, **({"cursor": cursor} if cursor else {})}
+            resp = self.client.get('/courses', headers=self.auth_student_headers, query_string=params)
+            self.assertEqual(200, resp.status_code)
+            self.assertLessEqual(len(resp.json['items']), 3)
+            course_ids += [course['id'] for course in resp.json['items']]
+            cursor = resp.json['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(self.course_ids, course_ids)
+
+        resp = self.client.get('/lector/courses', headers=self.auth_lector_headers, query_string={"sort": "-id", "limit": 2})
+        self.assertEqual(self.course_ids[:-3:-1], [course['id'] for course in resp.json['items']])
+        self.assertEqual({"id": self.course_ids[0], "courseName": "course0", "courseDescription": "description", "lectorUsername": "lector1",
+                          "memberCount": 0, "pendingRequestCount": 0},
+                         self.client.get('/lector/courses', headers=self.auth_lector_headers).json['items'][0])
+
+        self.assertEqual(400, self.client.get('/courses', headers=self.auth_student_headers, query_string={"limit": 0}).status_code)
+        self.assertEqual(400, self.client.get('/courses', headers=self.auth_student_headers, query_string={"cursor": "invalid"}).status_code)
+        for sort, value, last_id in (("courseName", "x", True), ("courseName", {"a": 1}, 1), ("courseName", 1, 1), ("id", "x", 1), ("id", 1, False)):
+            self.assertEqual(400, self.client.get('/courses', headers=self.auth_student_headers, query_string={"sort": sort, "cursor": encode_cursor(value, last_id)}).status_code)
+        self.assertEqual(400, self.client.get('/courses', headers=self.auth_student_headers, query_string={"sort": "unknown"}).status_code)
+
+    def testCoursesFilters(self):
+        resp = self.client.get('/courses', headers=self.auth_student_headers, query_string={"name": "course1"})
+        self.assertEqual([self.course_ids[1]], [course['id'] for course in resp.json['items']])
+        resp = self.client.get('/courses', headers=self.auth_student_headers, query_string={"lector": "student1"})
+        self.assertEqual([], resp.json['items'])
+
+    def testMembershipListings(self):
+        request_id = int(self.client.post('/request', headers=self.auth_student_headers, json={"studentId": self.student_id, "requestToCourse": self.course_ids[0], "requestToLector": self.lector_id}).json.get('id'))
+        declined_id = int(self.client.post('/request', headers=self.auth_student_headers, json={"studentId": self.student_id, "requestToCourse": self.course_ids[1], "requestToLector": self.lector_id}).json.get('id'))
+
+        resp = self.client.get('/lector/requests', headers=self.auth_lector_headers)
+        self.assertEqual([{"id": request_id, "courseName": "course0", "studentName": "student1"}, {"id": declined_id, "courseName": "course1", "studentName": "student1"}], resp.json['items'])
+        self.client.put(f'/user/acceptrequest/{request_id}', headers=self.auth_lector_headers)
+        self.client.put(f'/user/declinerequest/{declined_id}', headers=self.auth_lector_headers)
+
+        self.assertEqual([], self.client.get('/lector/requests', headers=self.auth_lector_headers).json['items'])
+        self.assertEqual([declined_id], [req['id'] for req in self.client.get('/lector/requests', headers=self.auth_lector_headers, query_string={"status": "Declined"}).json['items']])
+        self.assertEqual([self.course_ids[0]], [course['id'] for course in self.client.get('/student/courses', headers=self.auth_student_headers).json['items']])
+        courses = self.client.get('/courses', headers=self.auth_student_headers).json['items']
+        self.assertNotIn(self.course_ids[0], [course['id'] for course in courses])
+        self.assertEqual("Declined", courses[0]['requestStatus'])
+
+    def testBulkRequestActions(self):
+        other_lector_id = int(self.client.post('/auth/register', json={**self.test_lector, "username": "lector2"}).json.get('id'))
+        other_course_id = int(self.client.post('/course', headers={'Authorization': f'Basic ' + base64.b64encode(b"lector2:12345").decode("UTF-8")}, json={"courseName": "other", "courseDescription": "description", "courseLector": other_lector_id}).json.get('id'))
+        request_ids = [int(self.client.post('/request', headers=self.auth_student_headers, json={"studentId": self.student_id, "requestToCourse": course_id, "requestToLector": self.lector_id}).json.get('id')) for course_id in self.course_ids[:3]]
+        other_request_id = int(self.client.post('/request', headers=self.auth_student_headers, json={"studentId": self.student_id, "requestToCourse": other_course_id, "requestToLector": other_lector_id}).json.get('id'))
+
+        self.assertEqual(422, self.client.put('/user/requests', headers=self.auth_lector_headers, json={"ids": request_ids, "action": "unknown"}).status_code)
+        self.assertEqual(403, self.client.put('/user/requests', headers=self.auth_student_headers, json={"ids": request_ids, "action": "accept"}).status_code)
+
+        resp = self.client.put('/user/requests', headers=self.auth_lector_headers, json={"ids": request_ids[:2] + [other_request_id, other_request_id + 1000], "action": "accept"})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual([200, 200, 403, 404], [result['code'] for result in resp.json])
+        self.assertEqual(self.course_ids[:2], [course['id'] for course in self.client.get('/student/courses', headers=self.auth_student_headers).json['items']])
+
+        resp = self.client.put('/user/requests', headers=self.auth_lector_headers, json={"ids": [request_ids[2]], "action": "decline"})
+        self.assertEqual([{"id": request_ids[2], "code": 200, "message": "Declined"}], resp.json)
+        self.assertEqual([], self.client.get('/lector/requests', headers=self.auth_lector_headers).json['items'])
+
+        # the statements do not grow with the number of courses the requests are for
+        request_ids = [int(self.client.post('/request', headers=self.auth_student_headers, json={"studentId": self.student_id, "requestToCourse": course_id}).json.get('id')) for course_id in self.course_ids[3:]]
+        resp = self.client.put('/user/requests', headers=self.auth_lector_headers, json={"ids": request_ids, "action": "accept"})
+        self.assertEqual([200] * 4, [result['code'] for result in resp.json])
+        self.assertIn('desc="8 statements"', resp.headers['Server-Timing'])
+
+    def testCounters(self):
+        def lector_course(course_id):
+            return next(course for course in self.client.get('/lector/courses', headers=self.auth_lector_headers).json['items'] if course['id'] == course_id)
+
+        request_ids = [int(self.client.post('/request', headers=self.auth_student_headers, json={"studentId": self.student_id, "requestToCourse": course_id}).json.get('id')) for course_id in self.course_ids[:2]]
+        self.assertEqual(2, self.client.get('/user/lector1', headers=self.auth_lector_headers).json['pendingRequestCount'])
+        self.assertNotIn('pendingRequestCount', self.client.get('/user/student1', headers=self.auth_student_headers).json)
+        self.assertEqual({"memberCount": 0, "pendingRequestCount": 1}, {key: lector_course(self.course_ids[0])[key] for key in ("memberCount", "pendingRequestCount")})
+
+        self.assertEqual(200, self.client.put(f'/user/acceptrequest/{request_ids[0]}', headers=self.auth_lector_headers).status_code)
+        self.assertEqual(200, self.client.put(f'/user/declinerequest/{request_ids[1]}', headers=self.auth_lector_headers).status_code)
+        self.assertEqual(200, self.client.put(f'/user/declinerequest/{request_ids[1]}', headers=self.auth_lector_headers).status_code)
+        self.assertEqual(0, self.client.get('/user/lector1', headers=self.auth_lector_headers).json['pendingRequestCount'])
+        self.assertEqual({"memberCount": 1, "pendingRequestCount": 0}, {key: lector_course(self.course_ids[0])[key] for key in ("memberCount", "pendingRequestCount")})
+        self.assertEqual(1, self.client.get(f'/course/{self.course_ids[0]}', headers=self.auth_student_headers).json['memberCount'])
+
+        # a request settled by a concurrent transaction in the meantime is only counted once
+        request_id = int(self.client.post('/request', headers=self.auth_student_headers, json={"studentId": self.student_id, "requestToCourse": self.course_ids[2]}).json.get('id'))
+        self.assertEqual({request_id}, settle_pending(s, [request_row(s, request_id)], accept=False))
+        self.assertEqual(set(), settle_pending(s, [request_row(s, request_id)], accept=True))
+        s.commit()
+        self.assertEqual(0, s.query(Course.pendingRequestCount).filter(Course.id == self.course_ids[2]).scalar())
+
+        s.execute("UPDATE course SET memberCount = 5, pendingRequestCount = 5")
+        s.commit()
+        rebuild(s)
+        self.assertEqual((1, 0), s.query(Course.memberCount, Course.pendingRequestCount).filter(Course.id == self.course_ids[0]).one())
+
+        self.assertEqual(200, self.client.delete('/user/student1', headers=self.auth_student_headers).status_code)
+        self.assertEqual(0, lector_course(self.course_ids[0])['memberCount'])
+
+    def testDuplicateRequests(self):
+        new_request = {"studentId": self.student_id, "requestToCourse": self.course_ids[0]}
+        request_id = int(self.client.post('/request', headers=self.auth_student_headers, json=new_request).json.get('id'))
+        self.assertEqual(406, self.client.post('/request', headers=self.auth_student_headers, json=new_request).status_code)
+        self.assertEqual(404, self.client.post('/request', headers=self.auth_student_headers, json={**new_request, "requestToCourse": 0}).status_code)
+        with self.assertRaises(IntegrityError) as duplicate:
+            s.add(Request(studentId=self.student_id, requestToCourse=self.course_ids[0], requestToLector=self.lector_id))
+            s.commit()
+        s.rollback()
+        self.assertTrue(is_duplicate(duplicate.exception, active_request_key))
+        # another unique key is not taken for a request that was already sent
+        with self.assertRaises(IntegrityError) as other:
+            s.add(CourseMember(courseId=self.course_ids[0], userId=self.student_id))
+            s.add(CourseMember(courseId=self.course_ids[0], userId=self.student_id))
+            s.commit()
+        s.rollback()
+        self.assertFalse(is_duplicate(other.exception, active_request_key))
+        self.assertEqual(1, self.client.get('/user/lector1', headers=self.auth_lector_headers).json['pendingRequestCount'])
+
+        self.client.put(f'/user/declinerequest/{request_id}', headers=self.auth_lector_headers)
+        self.assertEqual(200, self.client.post('/request', headers=self.auth_student_headers, json=new_request).status_code)
+        self.assertEqual(1, self.client.get('/user/lector1', headers=self.auth_lector_headers).json['pendingRequestCount'])
+
+    def testCascadingDeletes(self):
+        for course_id in self.course_ids[:3]:
+            request_id = int(self.client.post('/request', headers=self.auth_student_headers, json={"studentId": self.student_id, "requestToCourse": course_id}).json.get('id'))
+            self.client.put(f'/user/acceptrequest/{request_id}', headers=self.auth_lector_headers)
+            self.client.post('/request', headers=self.auth_student_headers, json={"studentId": self.student_id, "requestToCourse": course_id + 3})
+
+        self.assertEqual(200, self.client.delete(f'/course/{self.course_ids[0]}', headers=self.auth_lector_headers).status_code)
+        self.assertEqual(0, s.query(CourseMember).filter(CourseMember.courseId == self.course_ids[0]).count())
+
+        self.assertEqual(1, delete_course_in_chunks(s, self.course_ids[3], chunk_size=1))
+        self.assertEqual(0, s.query(Request).filter(Request.requestToCourse == self.course_ids[3]).count())
+        self.assertEqual(2, self.client.get('/user/lector1', headers=self.auth_lector_headers).json['pendingRequestCount'])
+
+        self.assertEqual(200, self.client.delete('/user/student1', headers=self.auth_student_headers).status_code)
+        self.assertEqual((0, 0), (s.query(CourseMember).count(), s.query(Request).count()))
+
+    def testBackgroundDelete(self):
+        request_id = int(self.client.post('/request', headers=self.auth_student_headers, json={"studentId": self.student_id, "requestToCourse": self.course_ids[0]}).json.get('id'))
+        self.client.put(f'/user/acceptrequest/{request_id}', headers=self.auth_lector_headers)
+        self.client.post('/request', headers=self.auth_student_headers, json={"studentId": self.student_id, "requestToCourse": self.course_ids[0] + 1})
+
+        resp = self.client.delete(f'/course/{self.course_ids[0]}', headers=self.auth_lector_headers, query_string={"background": "true"})
+        self.assertEqual(202, resp.status_code)
+        self.wait_for_background()
+        self.assertEqual(404, self.client.get(f'/course/{self.course_ids[0]}', headers=self.auth_lector_headers).status_code)
+        self.assertEqual(0, s.query(CourseMember).count())
+
+        self.assertEqual(200, self.client.delete('/user/student1', headers=self.auth_student_headers).status_code)
+        self.assertEqual(0, s.query(Request).count())
+        self.assertEqual(0, self.client.get('/user/lector1', headers=self.auth_lector_headers).json['pendingRequestCount'])
+
+    def testMembershipCache(self):
+        def accept(course_id):
+            request_id = int(self.client.post('/request', headers=self.auth_student_headers, json={"studentId": self.student_id, "requestToCourse": course_id}).json.get('id'))
+            self.client.put(f'/user/acceptrequest/{request_id}', headers=self.auth_lector_headers)
+
+        accept(self.course_ids[0])
+        self.assertEqual(200, self.client.get(f'/course/{self.course_ids[0]}', headers=self.auth_student_headers).status_code)
+        self.assertEqual(403, self.client.get(f'/course/{self.course_ids[1]}', headers=self.auth_student_headers).status_code)
+        self.assertEqual({self.course_ids[0]}, memberships.get(self.student_id))
+
+        s.add(CourseMember(courseId=self.course_ids[1], userId=self.student_id))
+        s.commit()
+        self.assertEqual(403, self.client.get(f'/course/{self.course_ids[1]}', headers=self.auth_student_headers).status_code)
+        accept(self.course_ids[2])
+        self.assertEqual(200, self.client.get(f'/course/{self.course_ids[1]}', headers=self.auth_student_headers).status_code)
+
+        self.client.delete(f'/course/{self.course_ids[0]}', headers=self.auth_lector_headers)
+        self.assertIsNone(memberships.get(self.student_id))
+
+    def testRequestEvents(self):
+        start = bus.last_id
+        request_ids = [int(self.client.post('/request', headers=self.auth_student_headers, json={"studentId": self.student_id, "requestToCourse": course_id}).json.get('id')) for course_id in self.course_ids[:2]]
+        self.client.put(f'/user/acceptrequest/{request_ids[0]}', headers=self.auth_lector_headers)
+        self.client.put(f'/user/declinerequest/{request_ids[1]}', headers=self.auth_lector_headers)
+        bus.publish("request", {}, [self.student_id + self.lector_id])
+
+        resp = self.client.get('/events', headers={**self.auth_student_headers, 'Last-Event-ID': str(start)})
+        self.assertEqual("text/event-stream", resp.mimetype)
+        body = resp.get_data(as_text=True)
+        resp.close()
+        self.assertTrue(body.startswith("retry:"))
+        messages = body.split("\n\n")
+        self.assertEqual(0, bus.streams)
+        events = [json.loads(message.split("data: ")[1]) for message in messages if "data: " in message]
+        self.assertEqual([(request_ids[0], "OnHold"), (request_ids[1], "OnHold"), (request_ids[0], "Accepted"), (request_ids[1], "Declined")],
+                         [(event["id"], event["status"]) for event in events])
+        self.assertIn(f"id: {start + 5}", messages)
+
+        for _ in range(EVENT_MAX_STREAMS):
+            bus.open_stream(0)
+        try:
+            resp = self.client.get('/events', headers={**self.auth_student_headers, 'Last-Event-ID': str(start + 2)})
+            self.assertEqual(200, resp.status_code)
+            self.assertEqual(2, resp.get_data(as_text=True).count("event: request"))
+        finally:
+            for _ in range(EVENT_MAX_STREAMS):
+                bus.close_stream()
+
+        events, position = asyncio.run(bus.wait_async(self.lector_id, start + 4, 1))
+        self.assertEqual(([], start + 5), (events, position))
+        self.assertEqual((None, start + 5), bus.since(self.student_id, start + 6))
+
+    def testReplicaRouting(self):
+        with tempfile.TemporaryDirectory() as directory:
+            replica = create_engine(f"sqlite:///{directory}/replica.db")
+            Base.metadata.create_all(replica)
+            replicas.add(replica)
+            replicas.last_write = float("-inf")
+            try:
+                self.assertEqual([], self.client.get('/lector/courses', headers=self.auth_lector_headers).json['items'])
+                responses.clear()
+                self.assertEqual(self.course_ids, [course['id'] for course in self.client.get('/lector/courses', headers={**self.auth_lector_headers, PRIMARY_HEADER: "true"}).json['items']])
+
+                routed = session()
+                routed.info["replica"] = True
+                self.assertEqual(0, routed.query(Course).count())
+                routed.add(Course(courseName="course7", courseDescription="description", courseLector=self.lector_id))
+                routed.flush()
+                self.assertEqual(8, routed.query(Course).count())
+                routed.rollback()
+                routed.close()
+
+                replicas.mark_down(replica)
+                self.assertIsNone(replicas.next())
+            finally:
+                replicas.remove(replica)
+                replica.dispose()
+
+    def testCompiledSchemas(self):
+        schema = get_schema(CourseItemSchema, many=True)
+        for rows in (available_courses(s, self.student_id).all(), lector_courses(s, self.lector_id).all()):
+            self.assertEqual(Schema.dump(schema, rows), schema.dump(rows))
+        self.assertEqual("", schema.dump(available_courses(s, self.student_id).all())[0]['requestStatus'])
+        self.assertNotIn('requestStatus', schema.dump(lector_courses(s, self.lector_id).all())[0])
+
+        users = s.query(User).order_by(User.id).all()
+        self.assertEqual(Schema.dump(get_schema(UserSchema), users, many=True), get_schema(UserSchema).dump(users, many=True))
+        self.assertEqual(Schema.dump(get_schema(CourseSchema), s.get(Course, self.course_ids[0])), get_schema(CourseSchema).dump(s.get(Course, self.course_ids[0])))
+
+    def testImportCourses(self):
+        self.assertEqual([], self.client.get('/courses/search', headers=self.auth_student_headers, query_string={"q": "imported1"}).json['items'])
+        courses = f"courseName,courseDescription,courseLector\nimported1,description,{self.lector_id}\nimported2,,{self.lector_id}\nimported3,description,{self.student_id}\n"
+        resp = self.client.post('/import/courses', headers={**self.auth_lector_headers, "Content-Type": "text/csv"}, data=courses)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(1, resp.json['inserted'])
+        self.assertEqual([2, 3], [error['row'] for error in resp.json['errors']])
+        self.assertEqual(["imported1"], [course['courseName'] for course in self.client.get('/lector/courses', headers=self.auth_lector_headers, query_string={"name": "imported"}).json['items']])
+        self.assertEqual(["imported1"], [course['courseName'] for course in self.client.get('/courses/search', headers=self.auth_student_headers, query_string={"q": "imported1"}).json['items']])
+
+        members = f'{{"courseId": {self.course_ids[0]}, "userId": {self.student_id}}}\n{{"courseId": {self.course_ids[0]}, "userId": {self.student_id}}}\n'
+        resp = self.client.post('/import/members', headers=self.auth_lector_headers, data=members)
+        self.assertEqual({"inserted": 1, "errors": [{"row": 2, "errors": {"message": "User is already a member of this course."}}]}, resp.json)
+        self.assertEqual(404, self.client.post('/import/unknown', headers=self.auth_lector_headers, data="").status_code)
+
+    def testExportCourses(self):
+        resp = self.client.get('/export/courses', headers=self.auth_lector_headers)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("application/x-ndjson", resp.mimetype)
+        courses = [json.loads(line) for line in resp.data.decode().splitlines()]
+        self.assertEqual(self.course_ids, [course['id'] for course in courses])
+        self.assertEqual({"id": self.course_ids[0], "courseName": "course0", "courseDescription": "description", "courseLector": self.lector_id, "lectorUsername": "lector1"}, courses[0])
+
+        lines = self.client.get('/export/courses', headers=self.auth_lector_headers, query_string={"format": "csv"}).data.decode().splitlines()
+        self.assertEqual("id,courseName,courseDescription,courseLector,lectorUsername", lines[0])
+        self.assertEqual(len(self.course_ids) + 1, len(lines))
+        self.assertEqual(403, self.client.get('/export/courses', headers=self.auth_student_headers).status_code)
+
+    def testSearchCourses(self):
+        python_id = int(self.client.post('/course', headers=self.auth_lector_headers, json={"courseName": "Python", "courseDescription": "Programming in python", "courseLector": self.lector_id}).json.get('id'))
+        rust_id = int(self.client.post('/course', headers=self.auth_lector_headers, json={"courseName": "Rust", "courseDescription": "Systems programming", "courseLector": self.lector_id}).json.get('id'))
+
+        resp = self.client.get('/courses/search', headers=self.auth_student_headers, query_string={"q": "python programming"})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual([python_id, rust_id], [course['id'] for course in resp.json['items']])
+
+        first_page = self.client.get('/courses/search', headers=self.auth_student_headers, query_string={"q": "programming", "limit": 1}).json
+        second_page = self.client.get('/courses/search', headers=self.auth_student_headers, query_string={"q": "programming", "limit": 1, "cursor": first_page['next_cursor']}).json
+        self.assertEqual({python_id, rust_id}, {course['id'] for course in first_page['items'] + second_page['items']})
+        self.assertIsNone(second_page['next_cursor'])
+        self.assertEqual(400, self.client.get('/courses/search', headers=self.auth_student_headers, query_string={"q": "programming", "cursor": encode_cursor("programming", -1)}).status_code)
+
+        self.client.put(f'/course/{python_id}', headers=self.auth_lector_headers, json={"courseName": "Go", "courseDescription": "Concurrency", "courseLector": self.lector_id})
+        self.client.delete(f'/course/{rust_id}', headers=self.auth_lector_headers)
+        self.assertEqual([], self.client.get('/courses/search', headers=self.auth_student_headers, query_string={"q": "python programming"}).json['items'])
+        self.assertEqual([python_id], [course['id'] for course in self.client.get('/courses/search', headers=self.auth_student_headers, query_string={"q": "concurrency"}).json['items']])
+        self.assertEqual(400, self.client.get('/courses/search', headers=self.auth_student_headers).status_code)
+
+    def testConditionalGet(self):
+        resp = self.client.get('/courses', headers=self.auth_student_headers)
+        etag = resp.headers['ETag']
+        self.assertEqual(304, self.client.get('/courses', headers={**self.auth_student_headers, 'If-None-Match': etag}).status_code)
+
+        request_id = int(self.client.post('/request', headers=self.auth_student_headers, json={"studentId": self.student_id, "requestToCourse": self.course_ids[0], "requestToLector": self.lector_id}).json.get('id'))
+        self.client.put(f'/user/acceptrequest/{request_id}', headers=self.auth_lector_headers)
+        resp = self.client.get('/courses', headers={**self.auth_student_headers, 'If-None-Match': etag})
+        self.assertEqual(200, resp.status_code)
+        self.assertNotIn(self.course_ids[0], [course['id'] for course in resp.json['items']])
+
+        etag = self.client.get(f'/course/{self.course_ids[0]}', headers=self.auth_student_headers).headers['ETag']
+        self.assertEqual(304, self.client.get(f'/course/{self.course_ids[0]}', headers={**self.auth_student_headers, 'If-None-Match': etag}).status_code)
+        self.client.put(f'/course/{self.course_ids[0]}', headers=self.auth_lector_headers, json={"courseName": "renamed", "courseDescription": "description", "courseLector": self.lector_id})
+        resp = self.client.get(f'/course/{self.course_ids[0]}', headers={**self.auth_student_headers, 'If-None-Match': etag})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("renamed", resp.json['courseName'])
+
+    def testConditionalGetRequests(self):
+        for course_id in self.course_ids[:3]:
+            self.client.post('/request', headers=self.auth_student_headers, json={"studentId": self.student_id, "requestToCourse": course_id})
+        resp = self.client.get('/lector/requests', headers=self.auth_lector_headers)
+        self.assertEqual({"course0", "course1", "course2"}, {item['courseName'] for item in resp.json['items']})
+
+        def requests_after(etag):
+            resp = self.client.get('/lector/requests', headers={**self.auth_lector_headers, 'If-None-Match': etag})
+            self.assertEqual(200, resp.status_code)
+            return resp
+
+        self.client.put(f'/course/{self.course_ids[0]}', headers=self.auth_lector_headers, json={"courseName": "renamed", "courseDescription": "description", "courseLector": self.lector_id})
+        resp = requests_after(resp.headers['ETag'])
+        self.assertEqual({"renamed", "course1", "course2"}, {item['courseName'] for item in resp.json['items']})
+
+        self.assertEqual(200, self.client.put('/user/student1', headers=self.auth_student_headers, json={"username": "student2"}).status_code)
+        resp = requests_after(resp.headers['ETag'])
+        self.assertEqual({"student2"}, {item['studentName'] for item in resp.json['items']})
+
+        self.assertEqual(200, self.client.delete(f'/course/{self.course_ids[1]}', headers=self.auth_lector_headers).status_code)
+        resp = requests_after(resp.headers['ETag'])
+        self.assertEqual({"renamed", "course2"}, {item['courseName'] for item in resp.json['items']})
+
+        self.assertEqual(202, self.client.delete(f'/course/{self.course_ids[2]}', headers=self.auth_lector_headers, query_string={"background": "true"}).status_code)
+        self.wait_for_background()
+        resp = requests_after(resp.headers['ETag'])
+        self.assertEqual({"renamed"}, {item['courseName'] for item in resp.json['items']})
+
+    def testRequestMetrics(self):
+        resp = self.client.get('/courses', headers=self.auth_student_headers)
+        self.assertEqual(200, resp.status_code)
+        self.assertRegex(resp.headers['Server-Timing'], r'^db;dur=[0-9.]+;desc="[0-9]+ statements", total;dur=[0-9.]+$')
+        self.assertEqual(404, self.client.get('/course/0', headers=self.auth_lector_headers).status_code)
+
+        resp = self.client.get('/metrics')
+        self.assertEqual(200, resp.status_code)
+        body = resp.get_data(as_text=True)
+        self.assertIn('http_requests_total{method="GET",route="/courses",status="200"} 1', body)
+        self.assertIn('http_requests_total{method="GET",route="/course/<int:course_id>",status="404"} 1', body)
+        self.assertIn('db_statements_count{method="GET",route="/courses"} 1', body)
+        self.assertIn('http_request_duration_seconds_bucket{method="GET",route="/courses",le="+Inf"} 1', body)
+
+
+class TestQueryLog(unittest.TestCase):
+    def testFingerprint(self):
+        self.assertEqual("SELECT a FROM t WHERE id IN (?+) AND name = ? AND b = ? LIMIT ?",
+                         fingerprint("SELECT a FROM t WHERE id IN (%s, %s, %s) AND name = 'it''s' AND b = :b LIMIT 10"))
+        self.assertEqual(fingerprint("SELECT a FROM t WHERE id = 1"), fingerprint("SELECT a\nFROM t WHERE id = ?"))
+
+    def testQueryStats(self):
+        stats = QueryStats()
+        stats.add("SELECT ?", 0.5)
+        stats.add("SELECT ?", 0.25)
+        stats.add("DELETE FROM t", 0.1)
+        self.assertEqual([("SELECT ?", [2, 0.75, 0.5]), ("DELETE FROM t", [1, 0.1, 0.1])], stats.top())
+        self.assertIn('db_queries_total{fingerprint="SELECT ?"} 2', stats.render())
+
+
+class TestCache(unittest.TestCase):
+    def testMaxBytes(self):
+        cache = TTLCache(10, 60, 10, len)
+        cache.set("a", b"12345")
+        cache.set("b", b"1234")
+        cache.set("c", b"123")
+        self.assertEqual((None, b"1234", b"123"), (cache.get("a"), cache.get("b"), cache.get("c")))
+        self.assertEqual(7, cache.bytes)
+        cache.set("d", b"12345678901")
+        self.assertIsNone(cache.get("d"))
+        cache.invalidate("b")
+        self.assertEqual(3, cache.bytes)
+
+
+class TestAuthentication(AppTestCase):
+    def setUp(self) -> None:
+        self.client = self.make_client()
+
+        self.test_student = {"username": "student1", "firstName": "firstName", "lastName": "lastName", "password": "12345", "userType": "Student"}
+        self.auth_student_headers = {'Authorization': f'Basic ' + base64.b64encode(b"student1:12345").decode("UTF-8")}
+        self.student_id = int(self.client.post('/auth/register', json=self.test_student).json.get('id'))
+
+    def tearDown(self) -> None:
+        s.execute("DELETE FROM user")
+        s.commit()
+        clear_caches()
+
+    def testChangedPasswordIsRejected(self):
+        new_password_headers = {'Authorization': f'Basic ' + base64.b64encode(b"student1:54321").decode("UTF-8")}
+        self.assertEqual(200, self.client.get('/user/student1', headers=self.auth_student_headers).status_code)
+        self.assertEqual(200, self.client.put('/user/student1', headers=self.auth_student_headers, json={"password": "54321"}).status_code)
+        self.assertEqual(401, self.client.get('/user/student1', headers=self.auth_student_headers).status_code)
+        self.assertEqual(200, self.client.get('/user/student1', headers=new_password_headers).status_code)
+
+    def testBearerToken(self):
+        resp = self.client.post('/auth/login', json={"username": "student1", "password": "12345"})
+        self.assertEqual(200, resp.status_code)
+        token_headers = {'Authorization': 'Bearer ' + resp.json.get('token')}
+        self.assertEqual(200, self.client.get('/user/student1', headers=token_headers).status_code)
+        self.assertEqual(401, self.client.get('/user/student1', headers={'Authorization': 'Bearer invalid'}).status_code)
+        self.assertEqual(403, self.client.get('/lector/courses', headers=token_headers).status_code)
+
+        refreshed_headers = {'Authorization': 'Bearer ' + self.client.post('/auth/refresh', headers=token_headers).json.get('token')}
+        self.assertEqual(200, self.client.get('/user/student1', headers=refreshed_headers).status_code)
+
+        self.assertEqual(200, self.client.post('/auth/revoke', headers=token_headers).status_code)
+        self.assertEqual(401, self.client.get('/user/student1', headers=token_headers).status_code)
+        self.assertEqual(401, self.client.get('/user/student1', headers=refreshed_headers).status_code)
+        self.assertEqual(200, self.client.get('/user/student1', headers=self.auth_student_headers).status_code)
+
+    def testChangedPasswordRevokesTokens(self):
+        token_headers = {'Authorization': 'Bearer ' + self.client.post('/auth/login', json={"username": "student1", "password": "12345"}).json.get('token')}
+        self.assertEqual(200, self.client.put('/user/student1', headers=token_headers, json={"password": "54321"}).status_code)
+        self.assertEqual(401, self.client.get('/user/student1', headers=token_headers).status_code)
+        self.assertEqual(400, self.client.post('/auth/login', json={"username": "student1", "password": "12345"}).status_code)
+
+    def testLoginValidation(self):
+        self.assertEqual({"message": "No input data provided"}, self.client.post('/auth/login').json)
+        resp = self.client.post('/auth/login', json={"username": "student1"})
+        self.assertEqual(400, resp.status_code)
+        self.assertIn('password', resp.json)
+        self.assertEqual(400, self.client.post('/auth/login', json=["student1", "12345"]).status_code)
+        self.assertEqual(400, self.client.post('/auth/login', json={"username": "student1", "password": 12345}).status_code)
+
+    def testPasswordHashing(self):
+        stored = s.query(User.password).filter(User.id == self.student_id).scalar()
+        self.assertTrue(stored.startswith("$2b$05$"))
+        self.assertTrue(check_password("12345", stored))
+
+        for legacy in ("12345", bcrypt.hashpw(b"12345", bcrypt.gensalt(4)).decode()):
+            s.query(User).filter(User.id == self.student_id).update({"password": legacy})
+            s.commit()
+            clear_caches()
+            self.assertEqual(200, self.client.get('/user/student1', headers=self.auth_student_headers).status_code)
+            s.expire_all()
+            rehashed = s.query(User.password).filter(User.id == self.student_id).scalar()
+            self.assertTrue(rehashed.startswith("$2b$05$"))
+            self.assertFalse(needs_rehash(rehashed))
+
+        self.assertEqual(401, self.client.get('/user/student1', headers={'Authorization': f'Basic ' + base64.b64encode(b"student1:1234").decode("UTF-8")}).status_code)
+
+    def testAdmissionControl(self):
+        self.assertEqual("addr:127.0.0.1", admission_key(self.auth_student_headers['Authorization'], "127.0.0.1"))
+        self.assertEqual(200, self.client.get('/user/student1', headers=self.auth_student_headers).status_code)
+        limits = dict(admission.limits)
+        admission.limits["read"] = (0.01, 2)
+        try:
+            self.assertEqual(200, self.client.get('/user/student1', headers=self.auth_student_headers).status_code)
+            self.assertEqual(200, self.client.get('/user/student1', headers=self.auth_student_headers).status_code)
+            resp = self.client.get('/user/student1', headers=self.auth_student_headers)
+            self.assertEqual(429, resp.status_code)
+            self.assertLessEqual(99, int(resp.headers['Retry-After']))
+            self.assertEqual("user:%d" % self.student_id, admission_key(self.auth_student_headers['Authorization'], "127.0.0.1"))
+            self.assertEqual(200, self.client.put('/user/student1', headers=self.auth_student_headers, json={"firstName": "name"}).status_code)
+            self.assertEqual("addr:127.0.0.1", admission_key('Basic ' + base64.b64encode(b"student1:1234").decode("UTF-8"), "127.0.0.1"))
+        finally:
+            admission.limits.update(limits)
+        self.assertIn('admission_requests_total{class="read",result="rate_limited"} 1', self.client.get('/metrics').get_data(as_text=True))
+
+        limited = Admission({"read": (0, 0)}, 1)
+        self.assertIsNone(limited.admit("user:1", "read"))
+        self.assertEqual((503, 1), limited.admit("user:2", "read"))
+        limited.release()
+        self.assertIsNone(limited.admit("user:2", "read"))
+        self.assertEqual(1, limited.in_flight)
+
+    def testDeletedUserIsRejected(self):
+        self.assertEqual(200, self.client.get('/user/student1', headers=self.auth_student_headers).status_code)
+        self.assertEqual(200, self.client.delete('/user/student1', headers=self.auth_student_headers).status_code)
+        self.assertEqual(401, self.client.get('/user/student1', headers=self.auth_student_headers).status_code)
+
+
+class TestAsyncApi(unittest.TestCase):
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        self.client = async_app.test_client()
+
+        self.test_student = {"username": "student1", "firstName": "firstName", "lastName": "lastName", "password": "12345", "userType": "Student"}
+        self.test_lector = {"username": "lector1", "firstName": "firstName", "lastName": "lastName", "password": "12345", "userType": "Lector"}
+
+        self.auth_student_headers = {'Authorization': f'Basic ' + base64.b64encode(b"student1:12345").decode("UTF-8")}
+        self.auth_lector_headers = {'Authorization': f'Basic ' + base64.b64encode(b"lector1:12345").decode("UTF-8")}
+
+        self.student_id = self.call('POST', '/auth/register', json=self.test_student)[1].get('id')
+        self.lector_id = self.call('POST', '/auth/register', json=self.test_lector)[1].get('id')
+
+    def tearDown(self) -> None:
+        self.loop.run_until_complete(dispose_async_engines())
+        self.loop.close()
+        s.execute("DELETE FROM request")
+        s.execute("DELETE FROM courseMember")
+        s.execute("DELETE FROM course")
+        s.execute("DELETE FROM user")
+        s.commit()
+        clear_caches()
+
+    def call(self, method, path, **kwargs):
+        async def send():
+            resp = await self.client.open(path, method=method, **kwargs)
+            data = await resp.get_data()
+            return resp.status_code, json.loads(data) if resp.mimetype == 'application/json' else data
+
+        return self.loop.run_until_complete(send())
+
+    def testUserAuthentication(self):
+        self.assertEqual(200, self.call('GET', '/user/student1', headers=self.auth_student_headers)[0])
+        self.assertEqual(401, self.call('GET', '/user/student1')[0])
+        self.assertEqual(403, self.call('GET', '/user/lector1', headers=self.auth_student_headers)[0])
+
+        token = self.call('POST', '/auth/login', json={"username": "student1", "password": "12345"})[1].get('token')
+        token_headers = {'Authorization': 'Bearer ' + token}
+        self.assertEqual(200, self.call('GET', '/user/student1', headers=token_headers)[0])
+        self.assertEqual(200, self.call('POST', '/auth/revoke', headers=token_headers)[0])
+        self.assertEqual(401, self.call('GET', '/user/student1', headers=token_headers)[0])
+
+    def testCourseEnrollment(self):
+        course = {"courseName": "course1", "courseDescription": "description", "courseLector": self.lector_id}
+        code, created = self.call('POST', '/course', headers=self.auth_lector_headers, json=course)
+        self.assertEqual(200, code)
+        course_id = created['id']
+
+        code, page = self.call('GET', '/courses', headers=self.auth_student_headers)
+        self.assertEqual(200, code)
+        self.assertEqual([course_id], [item['id'] for item in page['items']])
+        self.assertEqual(403, self.call('GET', f'/course/{course_id}', headers=self.auth_student_headers)[0])
+
+        code, req = self.call('POST', '/request', headers=self.auth_student_headers, json={"studentId": self.student_id, "requestToCourse": course_id})
+        self.assertEqual(200, code)
+        self.assertEqual(406, self.call('POST', '/request', headers=self.auth_student_headers, json={"studentId": self.student_id, "requestToCourse": course_id})[0])
+        self.assertEqual(1, self.call('GET', '/user/lector1', headers=self.auth_lector_headers)[1]['pendingRequestCount'])
+        self.assertEqual(200, self.call('PUT', f'/user/acceptrequest/{req["id"]}', headers=self.auth_lector_headers)[0])
+        code, course = self.call('GET', f'/course/{course_id}', headers=self.auth_student_headers)
+        self.assertEqual(200, code)
+        self.assertEqual((1, 0), (course['memberCount'], course['pendingRequestCount']))
+
+        code, export = self.call('GET', '/export/members', headers=self.auth_lector_headers)
+        self.assertEqual(200, code)
+        self.assertEqual([self.student_id], [json.loads(line)['userId'] for line in export.splitlines()])
+
+    def testRequestMetrics(self):
+        async def get_courses():
+            return await self.client.get('/courses', headers=self.auth_student_headers)
+
+        resp = self.loop.run_until_complete(get_courses())
+        self.assertEqual(200, resp.status_code)
+        self.assertRegex(resp.headers['Server-Timing'], r'^db;dur=[0-9.]+;desc="[1-9][0-9]* statements"')
+        code, body = self.call('GET', '/metrics')
+        self.assertEqual(200, code)
+        self.assertIn('http_requests_total{method="GET",route="/courses",status="200"} 1', body.decode())
+
+
+class TestUserInteractionAsync(AsyncAppTestCase, TestUserInteraction):
+    pass
+
+
+class TestCourseInteractionAsync(AsyncAppTestCase, TestCourseInteraction):
+    pass
+
+
+class TestCourseListingAsync(AsyncAppTestCase, TestCourseListing):
+    @unittest.skip("the async app has a replica pool of its own, built from the same settings")
+    def testReplicaRouting(self):
+        pass
+
+
+class TestAuthenticationAsync(AsyncAppTestCase, TestAuthentication):
+    pass